@@ -1,21 +1,48 @@
 import os
+import shutil
+import sys
 
+from dotenv import load_dotenv
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
+# Loaded here rather than only in run.py so that every entry point (the
+# server, the CLI, scripts) resolves DATA_DIR from the same .env.
+load_dotenv()
+
 db = SQLAlchemy()
 
 _DEFAULT_DATA_DIR = os.path.expanduser("~/.names-and-faces")
 
+
+def _default_cache_dir() -> str:
+    """Return the app's directory in the platform's per-user cache location."""
+    if sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "names-and-faces")
+
+
 DATA_DIR = os.environ.get("NAMES_AND_FACES_DATA_DIR", _DEFAULT_DATA_DIR)
 MEDIA_DIR = os.path.join(DATA_DIR, "media")
+# Built decks and re-encoded photos, which can be rebuilt at any time. Kept out
+# of DATA_DIR, which may be synced to a backup (see the README).
+CACHE_DIR = os.environ.get("NAMES_AND_FACES_CACHE_DIR") or _default_cache_dir()
+# Where the cache used to be.
+_OLD_CACHE_DIR = os.path.join(DATA_DIR, "cache")
 
 
-def create_app() -> Flask:
+def create_app(register_blueprints: bool = True) -> Flask:
+    """Create the app. Without blueprints it only sets up the database, which
+    is all the CLI needs and keeps the scraper stack from being imported."""
     app = Flask(__name__)
 
     os.makedirs(DATA_DIR, exist_ok=True)
     os.makedirs(MEDIA_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if os.path.realpath(_OLD_CACHE_DIR) != os.path.realpath(CACHE_DIR):
+        shutil.rmtree(_OLD_CACHE_DIR, ignore_errors=True)
 
     app.config["SQLALCHEMY_DATABASE_URI"] = (
         f"sqlite:///{os.path.join(DATA_DIR, 'names_and_faces.db')}"
@@ -26,19 +53,52 @@ def create_app() -> Flask:
 
     db.init_app(app)
 
-    from app.routes.deck import deck_bp
-    from app.routes.import_csv import import_csv_bp
-    from app.routes.people import people_bp
-    from app.routes.scraper import scraper_bp
+    if register_blueprints:
+        from app.routes.deck import deck_bp
+        from app.routes.import_csv import import_csv_bp
+        from app.routes.people import people_bp
+        from app.routes.scraper import scraper_bp
 
-    app.register_blueprint(people_bp)
-    app.register_blueprint(deck_bp, url_prefix="/deck")
-    app.register_blueprint(scraper_bp, url_prefix="/scrape")
-    app.register_blueprint(import_csv_bp, url_prefix="/import")
+        app.register_blueprint(people_bp)
+        app.register_blueprint(deck_bp, url_prefix="/deck")
+        app.register_blueprint(scraper_bp, url_prefix="/scrape")
+        app.register_blueprint(import_csv_bp, url_prefix="/import")
 
     with app.app_context():
         from app import models  # noqa: F401
 
         db.create_all()
+        _add_missing_columns()
+        _create_missing_indexes()
+
+        from app.services.deck_generator import (
+            refresh_note_fields,
+            template_timestamp,
+        )
+
+        refresh_note_fields()
+        # Recorded up front, so exports normally only read it.
+        template_timestamp()
 
     return app
+
+
+def _add_missing_columns() -> None:
+    """Add nullable columns declared on existing tables, which create_all() skips."""
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    col_type = column.type.compile(db.engine.dialect)
+                    conn.exec_driver_sql(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}'
+                    )
+
+
+def _create_missing_indexes() -> None:
+    """Add indexes declared on existing tables, which create_all() skips."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
@@ -0,0 +1,193 @@
+"""Command-line entry point, for producing decks without the web server.
+
+Usage:
+  names-and-faces export -o deck.apkg
+  names-and-faces export --mode changed -o delta.apkg
+  names-and-faces export --source csv --changed-since 2026-01-01 -o new.apkg
+  names-and-faces sync
+"""
+
+import argparse
+import shutil
+import sys
+from datetime import datetime, timezone
+
+import requests
+
+from app import create_app, db
+from app.services.anki_sync import (
+    ANKICONNECT_URL,
+    AnkiConnect,
+    AnkiConnectError,
+    sync_people,
+)
+from app.services.deck_generator import SPLIT_MODES
+from app.services.export_history import PendingExport
+from app.services.export_metrics import ExportMetrics
+from app.services.exports import (
+    EXPORT_MODES,
+    ExportSelection,
+    finish_export,
+    prepare_export,
+)
+from app.services.images import EXPORT_PROFILES
+
+
+def _parse_since(value: str) -> datetime:
+    """Parse an ISO date or datetime; naive values are taken as local time."""
+    try:
+        return datetime.fromisoformat(value).astimezone(timezone.utc)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO date or datetime: {value}")
+
+
+def _read_ids(args: argparse.Namespace) -> list[str]:
+    ids = [i for value in args.ids for i in value.split(",") if i.strip()]
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            ids.extend(line.strip() for line in f if line.strip())
+    return [i.strip() for i in ids]
+
+
+def export(args: argparse.Namespace) -> int:
+    app = create_app(register_blueprints=False)
+    metrics = ExportMetrics(f"export {args.mode}", trace_memory=args.trace_memory)
+    with app.app_context():
+        started_at = datetime.now(timezone.utc)
+        with ExportSelection(
+            _read_ids(args),
+            args.mode,
+            sources=args.source,
+            changed_since=args.changed_since,
+        ) as selection:
+            count = selection.count()
+            if not count:
+                # Not a failure: a scheduled "changed" run with no edits ends here.
+                print("Nothing to export; no package written.", file=sys.stderr)
+                return 0
+
+            def build() -> tuple[str, PendingExport]:
+                return prepare_export(
+                    selection,
+                    started_at,
+                    split_by=args.split_by,
+                    profile=args.profile,
+                    metrics=metrics,
+                )
+
+            package, pending = build()
+            try:
+                shutil.copyfile(package, args.output)
+            except FileNotFoundError:
+                # Another export pruned the cached package before it was copied.
+                package, pending = build()
+                shutil.copyfile(package, args.output)
+            finish_export(selection, pending, metrics)
+
+    print(f"Exported {count} people to {args.output}")
+    if args.timings or args.trace_memory:
+        print(metrics.summary(), file=sys.stderr)
+    return 0
+
+
+def sync(args: argparse.Namespace) -> int:
+    app = create_app(register_blueprints=False)
+    client = AnkiConnect(args.url) if args.url else AnkiConnect()
+    with app.app_context():
+        with ExportSelection(
+            _read_ids(args),
+            "full",
+            sources=args.source,
+            changed_since=args.changed_since,
+        ) as selection:
+            try:
+                result = sync_people(selection, client, profile=args.profile)
+            except (requests.RequestException, AnkiConnectError) as e:
+                print(f"Sync failed: {e}", file=sys.stderr)
+                return 1
+            selection.close(commit=False)
+            db.session.commit()
+
+    print(
+        f"Added {result['notes_added']}, updated {result['notes_updated']}, "
+        f"{result['notes_unchanged']} unchanged; "
+        f"sent {result['media_files']} photos ({result['media_bytes']} bytes)"
+    )
+    return 0
+
+
+def _add_selection_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument(
+        "--ids",
+        action="append",
+        default=[],
+        metavar="ID[,ID...]",
+        help="only include these person ids (repeatable)",
+    )
+    p.add_argument("--ids-file", help="file with one person id per line")
+    p.add_argument(
+        "--source",
+        action="append",
+        default=[],
+        help="only include people from this source, e.g. csv or linkedin (repeatable)",
+    )
+    p.add_argument(
+        "--changed-since",
+        type=_parse_since,
+        metavar="DATE",
+        help="only include people edited after this ISO date/datetime",
+    )
+    p.add_argument(
+        "--profile",
+        choices=sorted(EXPORT_PROFILES),
+        default="full",
+        help="photo encoding: full as stored, or mobile (200px, quality 70)",
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="names-and-faces")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("export", help="write an Anki package")
+    p.add_argument(
+        "-o", "--output", default="names_and_faces.apkg", help="output .apkg path"
+    )
+    p.add_argument(
+        "--mode",
+        choices=sorted(EXPORT_MODES),
+        default="full",
+        help="full deck, update (skip photos Anki has), or changed since last export",
+    )
+    _add_selection_args(p)
+    p.add_argument(
+        "--split-by",
+        choices=sorted(SPLIT_MODES),
+        help="put notes into sub-decks by source or first letter",
+    )
+    p.add_argument(
+        "--timings", action="store_true", help="print how long each stage took"
+    )
+    p.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="also measure each stage's peak memory (slow)",
+    )
+    p.set_defaults(func=export)
+
+    p = commands.add_parser(
+        "sync", help="push new and changed notes to Anki through AnkiConnect"
+    )
+    _add_selection_args(p)
+    p.add_argument("--url", help=f"AnkiConnect address (default {ANKICONNECT_URL})")
+    p.set_defaults(func=sync)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
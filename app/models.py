@@ -1,6 +1,8 @@
 import uuid
 from datetime import datetime, timezone
 
+from sqlalchemy import event
+
 from app import db
 
 
@@ -13,7 +15,8 @@ class Person(db.Model):  # type: ignore[name-defined]
 
     id = db.Column(db.String(36), primary_key=True, default=_new_uuid)
     name = db.Column(db.Text, nullable=False)
-    face_filename = db.Column(db.Text, nullable=True)
+    # Shared by everyone with the same photo; see images.save_and_optimize.
+    face_filename = db.Column(db.Text, nullable=True, index=True)
     context = db.Column(db.Text, nullable=True, default="")
 
     card_face_to_name = db.Column(db.Boolean, default=True, nullable=False)
@@ -29,8 +32,15 @@ class Person(db.Model):  # type: ignore[name-defined]
         db.DateTime,
         default=lambda: datetime.now(timezone.utc),
         onupdate=lambda: datetime.now(timezone.utc),
+        index=True,
     )
 
+    # The person's Anki note, rendered whenever the row is written so exports
+    # can copy it as-is. See deck_generator.render_note.
+    note_guid = db.Column(db.Text, nullable=True)
+    note_fields = db.Column(db.Text, nullable=True)
+    note_version = db.Column(db.Integer, nullable=True)
+
     def has_context(self) -> bool:
         return bool(self.context and self.context.strip())
 
@@ -49,3 +59,64 @@ class Person(db.Model):  # type: ignore[name-defined]
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
+
+
+@event.listens_for(Person, "before_insert")
+@event.listens_for(Person, "before_update")
+def _render_note(mapper, connection, person: Person) -> None:  # type: ignore[no-untyped-def]
+    # Imported here because the deck generator pulls in genanki and Pillow.
+    from app.services.deck_generator import render_note
+
+    # Column defaults are only applied by the INSERT itself, after this hook,
+    # so fill in the ones the note depends on.
+    if person.id is None:
+        person.id = _new_uuid()
+    for column in mapper.columns:
+        default = column.default
+        if default is not None and default.is_scalar:
+            if getattr(person, column.key) is None:
+                setattr(person, column.key, default.arg)
+    render_note(person)
+
+
+class ExportedMedia(db.Model):  # type: ignore[name-defined]
+    """A media file that has gone out in an exported deck, by content hash."""
+
+    __tablename__ = "exported_media"
+
+    filename = db.Column(db.Text, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    exported_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+class ExportRecord(db.Model):  # type: ignore[name-defined]
+    """One export handed to the user, used as the baseline for delta exports."""
+
+    __tablename__ = "export_history"
+
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime, nullable=False, index=True)
+    mode = db.Column(db.Text, nullable=False)
+    partial = db.Column(db.Boolean, default=False, nullable=False)
+    person_count = db.Column(db.Integer, nullable=False)
+
+
+class TemplateVersion(db.Model):  # type: ignore[name-defined]
+    """When a version of the card templates last came into use, by content hash."""
+
+    __tablename__ = "template_versions"
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    current_since = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class SyncedNote(db.Model):  # type: ignore[name-defined]
+    """A note pushed to Anki over AnkiConnect, with the fields it was sent."""
+
+    __tablename__ = "anki_sync_notes"
+
+    guid = db.Column(db.Text, primary_key=True)
+    person_id = db.Column(db.String(36), nullable=False, index=True)
+    note_id = db.Column(db.Integer, nullable=False)
+    fields_sha256 = db.Column(db.String(64), nullable=False)
+    synced_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
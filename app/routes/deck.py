@@ -1,35 +1,169 @@
-import os
-import tempfile
+from datetime import datetime, timezone
 
-from flask import Blueprint, request, send_file, redirect, url_for, flash
+import requests
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    request,
+    send_file,
+    url_for,
+)
 
-from app.models import Person
-from app.services.deck_generator import generate_deck
+from app import db
+from app.services.anki_sync import AnkiConnectError, sync_people
+from app.services.deck_generator import SPLIT_MODES
+from app.services.export_history import PendingExport
+from app.services.export_jobs import get_job, submit_export
+from app.services.export_metrics import ExportMetrics, recent_exports
+from app.services.exports import (
+    EXPORT_MODES,
+    ExportSelection,
+    finish_export,
+    prepare_export,
+)
+from app.services.images import EXPORT_PROFILES
 
 deck_bp = Blueprint("deck", __name__)
 
 
-@deck_bp.route("/export", methods=["POST"])
-def export_deck():
-    person_ids = request.form.getlist("person_ids")
-
-    if person_ids:
-        people = Person.query.filter(Person.id.in_(person_ids)).all()
-    else:
-        people = Person.query.all()
-
-    if not people:
-        flash("No people to export.", "error")
-        return redirect(url_for("people.index"))
+def _read_export_params() -> tuple[list[str], str, str | None, str]:
+    person_ids = request.values.getlist("person_ids")
+    mode = request.values.get("mode", "full")
+    if mode not in EXPORT_MODES:
+        mode = "full"
+    split_by = request.values.get("split_by") or None
+    if split_by not in SPLIT_MODES:
+        split_by = None
+    profile = request.values.get("profile", "full")
+    if profile not in EXPORT_PROFILES:
+        profile = "full"
+    return person_ids, mode, split_by, profile
 
-    output_dir = tempfile.mkdtemp()
-    output_path = os.path.join(output_dir, "names_and_faces.apkg")
 
-    generate_deck(people, output_path)
-
-    return send_file(
+def _send_deck(output_path: str, etag: str | None = None):  # type: ignore[no-untyped-def]
+    response = send_file(
         output_path,
         as_attachment=True,
         download_name="names_and_faces.apkg",
         mimetype="application/octet-stream",
+        etag=etag or True,
+    )
+    response.cache_control.no_cache = True
+    return response
+
+
+@deck_bp.route("/export", methods=["GET", "POST"])
+def export_deck():
+    """Export a deck. GET with the same parameters suits polling scripts.
+
+    Responds 304 when the client's If-None-Match still matches, which costs a
+    single aggregate query instead of a deck build.
+    """
+    person_ids, mode, split_by, profile = _read_export_params()
+
+    started_at = datetime.now(timezone.utc)
+    with ExportSelection(person_ids, mode) as selection:
+        etag = selection.etag(split_by, profile)
+        # If-None-Match compares weakly, so a proxy that weakens the tag
+        # (say, when it compresses the response) still gets a 304.
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        if not selection.count():
+            if mode == "changed":
+                flash("Nothing changed since the last export.", "info")
+            else:
+                flash("No people to export.", "error")
+            return redirect(url_for("people.index"))
+
+        metrics = ExportMetrics(f"export {mode}")
+
+        def build() -> tuple[str, PendingExport]:
+            return prepare_export(
+                selection,
+                started_at,
+                split_by=split_by,
+                profile=profile,
+                metrics=metrics,
+            )
+
+        output_path, pending = build()
+        try:
+            response = _send_deck(output_path, etag)
+        except FileNotFoundError:
+            # Another export pruned the cached package before it was opened.
+            output_path, pending = build()
+            response = _send_deck(output_path, etag)
+        finish_export(selection, pending, metrics)
+    response.headers["Server-Timing"] = metrics.server_timing()
+    return response
+
+
+@deck_bp.route("/metrics")
+def export_metrics():
+    """Stage timings of the most recent exports, newest first."""
+    return jsonify(recent_exports())
+
+
+@deck_bp.route("/sync", methods=["POST"])
+def sync_deck():
+    """Push new and changed notes straight into Anki through AnkiConnect."""
+    person_ids, _, _, profile = _read_export_params()
+    with ExportSelection(person_ids, "full") as selection:
+        try:
+            result = sync_people(selection, profile=profile)
+        except (requests.RequestException, AnkiConnectError) as e:
+            return jsonify({"error": f"Could not sync with Anki: {e}"}), 502
+        selection.close(commit=False)
+        db.session.commit()
+    return jsonify(result)
+
+
+@deck_bp.route("/jobs", methods=["POST"])
+def create_export_job():
+    """Start an export in the background and return its job id."""
+    person_ids, mode, split_by, profile = _read_export_params()
+    job = submit_export(
+        current_app._get_current_object(),  # type: ignore[attr-defined]
+        person_ids,
+        mode,
+        split_by,
+        profile,
     )
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers["Location"] = url_for("deck.export_job_status", job_id=job.id)
+    return response
+
+
+@deck_bp.route("/jobs/<job_id>")
+def export_job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown export job"}), 404
+    return jsonify(job.to_dict())
+
+
+@deck_bp.route("/jobs/<job_id>/download")
+def export_job_download(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown export job"}), 404
+    if job.status != "done" or not job.output_path:
+        return jsonify(job.to_dict()), 409
+    try:
+        response = _send_deck(job.output_path)
+    except FileNotFoundError:
+        return jsonify({"error": "Export has expired, start a new one"}), 410
+    # The package is open for sending, so the export now counts as delivered.
+    pending = job.take_pending()
+    if pending is not None:
+        pending.record()
+        db.session.commit()
+    return response
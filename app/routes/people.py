@@ -2,10 +2,12 @@ import os
 
 from flask import (
     Blueprint,
+    abort,
     flash,
     redirect,
     render_template,
     request,
+    send_file,
     send_from_directory,
     url_for,
 )
@@ -16,6 +18,10 @@ from app.models import Person
 
 people_bp = Blueprint("people", __name__)
 
+# Media and thumbnail URLs always name the same bytes, so browsers can keep
+# them for a year without revalidating.
+_MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 
 
@@ -29,6 +35,12 @@ def _save_photo(file) -> str:  # type: ignore[type-arg]
     return save_and_optimize(file)
 
 
+def _release_photo(filename: str | None) -> None:
+    from app.services.images import delete_unreferenced_media
+
+    delete_unreferenced_media(filename)
+
+
 def _read_card_toggles() -> dict:
     return {
         "card_face_to_name": "card_face_to_name" in request.form,
@@ -49,7 +61,11 @@ def index():
         )
     else:
         people = Person.query.order_by(Person.created_at.desc()).all()
-    return render_template("index.html", people=people, search=search)
+    from app.services.images import WEBP_SUPPORTED
+
+    return render_template(
+        "index.html", people=people, search=search, webp=WEBP_SUPPORTED
+    )
 
 
 @people_bp.route("/check-duplicate", methods=["POST"])
@@ -128,17 +144,16 @@ def edit_person(person_id: str):
         for key, val in _read_card_toggles().items():
             setattr(person, key, val)
 
+        old_face_filename = person.face_filename
         photo = request.files.get("photo")
         if photo and photo.filename and _allowed_file(photo.filename):
-            if person.face_filename:
-                old_path = os.path.join(MEDIA_DIR, person.face_filename)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
             person.face_filename = _save_photo(photo)
         elif request.form.get("scraped_face_filename") and not person.face_filename:
             person.face_filename = request.form["scraped_face_filename"]
 
         db.session.commit()
+        if old_face_filename != person.face_filename:
+            _release_photo(old_face_filename)
         flash(f"Updated {person.name}.", "success")
         return redirect(url_for("people.index"))
 
@@ -148,17 +163,51 @@ def edit_person(person_id: str):
 @people_bp.route("/delete/<person_id>", methods=["POST"])
 def delete_person(person_id: str):
     person = Person.query.get_or_404(person_id)
-    if person.face_filename:
-        photo_path = os.path.join(MEDIA_DIR, person.face_filename)
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
     name = person.name
+    face_filename = person.face_filename
     db.session.delete(person)
     db.session.commit()
+    _release_photo(face_filename)
     flash(f"Deleted {name}.", "success")
     return redirect(url_for("people.index"))
 
 
+def _cache_forever(response):  # type: ignore[no-untyped-def]
+    response.cache_control.immutable = True
+    return response
+
+
 @people_bp.route("/media/<filename>")
 def serve_media(filename: str):
-    return send_from_directory(MEDIA_DIR, secure_filename(filename))
+    from app.services.images import media_sha256
+
+    filename = secure_filename(filename)
+    etag = media_sha256(filename)
+    if etag is None:
+        abort(404)
+    return _cache_forever(
+        send_from_directory(MEDIA_DIR, filename, etag=etag, max_age=_MEDIA_MAX_AGE)
+    )
+
+
+@people_bp.route("/thumb/<int:size>/<filename>")
+def serve_thumbnail(size: int, filename: str):
+    """A downscaled photo for the people grid; add ?format=webp for WebP."""
+    from app.services.images import thumbnail_path
+
+    webp = request.args.get("format") == "webp"
+    try:
+        path = thumbnail_path(secure_filename(filename), size, webp)
+    except OSError:
+        abort(404)
+    if path is None:
+        abort(404)
+    # Derivatives are named by source hash, size, quality and format.
+    return _cache_forever(
+        send_file(
+            path,
+            mimetype="image/webp" if webp else "image/jpeg",
+            etag=os.path.basename(path),
+            max_age=_MEDIA_MAX_AGE,
+        )
+    )
@@ -0,0 +1,353 @@
+"""Push deck changes into a running Anki through AnkiConnect.
+
+Importing a package makes Anki re-read every note in it. A sync instead sends
+only the notes whose fields changed since they were last pushed, plus the
+photos Anki doesn't have yet, over AnkiConnect's HTTP API. Notes are matched
+by their stable GUID, which also travels as a tag so that notes first imported
+from a package are found too.
+
+AnkiConnect's addNote and createModel can't set a note's GUID or the note
+type's id, so new notes are instead imported from a small package built like
+any export. That keeps them matching the packages the user imports later.
+
+Set ANKICONNECT_URL to reach Anki somewhere other than AnkiConnect's default
+address, and ANKICONNECT_KEY if AnkiConnect is configured with an API key.
+"""
+
+import base64
+import hashlib
+import itertools
+import os
+import tempfile
+from collections.abc import Iterable
+from datetime import datetime, timezone
+from typing import Any
+
+import genanki
+import requests
+from sqlalchemy.dialects.sqlite import insert
+
+from app import db
+from app.models import SyncedNote
+from app.services.deck_generator import (
+    GUID_TAG_PREFIX,
+    MODEL_ID,
+    generate_deck,
+    get_model,
+    guid_tag,
+    person_note,
+)
+from app.services.export_history import already_exported_media, record_media
+from app.services.images import export_media_path
+
+ANKICONNECT_URL = os.environ.get("ANKICONNECT_URL", "http://127.0.0.1:8765")
+ANKICONNECT_KEY = os.environ.get("ANKICONNECT_KEY", "")
+
+_API_VERSION = 6
+# Actions sent per "multi" request.
+_MULTI_BATCH_SIZE = 100
+# Notes described per notesInfo call when matching notes by tag.
+_NOTES_INFO_BATCH_SIZE = 500
+# Base64 photo data sent per request, roughly.
+_MEDIA_BATCH_BYTES = 8 * 1024 * 1024
+_UPSERT_BATCH_SIZE = 1000
+# importPackage reads a path relative to Anki's media folder, so the package of
+# new notes is stored there under this name for the length of the import.
+_IMPORT_PACKAGE_NAME = "_names_and_faces_sync.apkg"
+
+
+class AnkiConnectError(Exception):
+    """AnkiConnect answered a request with an error."""
+
+
+def _action(name: str, **params: object) -> dict:
+    # Actions inside "multi" need their own version to get {result, error}
+    # replies rather than bare results.
+    return {"action": name, "version": _API_VERSION, "params": params}
+
+
+class AnkiConnect:
+    """Minimal client for the AnkiConnect API."""
+
+    def __init__(
+        self,
+        url: str = ANKICONNECT_URL,
+        key: str = ANKICONNECT_KEY,
+        timeout: float = 30,
+    ) -> None:
+        self.url = url
+        self.key = key
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def invoke(self, action: str, **params: object) -> Any:
+        payload = _action(action, **params)
+        if self.key:
+            payload["key"] = self.key
+        resp = self._session.post(self.url, json=payload, timeout=self.timeout)
+        resp.raise_for_status()
+        body = resp.json()
+        if body.get("error"):
+            raise AnkiConnectError(f"{action}: {body['error']}")
+        return body["result"]
+
+    def multi(self, actions: list[dict]) -> list[tuple[Any, str | None]]:
+        """Run `actions` in batched multi requests; return (result, error) pairs."""
+        results: list[tuple[Any, str | None]] = []
+        for batch in itertools.batched(actions, _MULTI_BATCH_SIZE):
+            replies = self.invoke("multi", actions=list(batch))
+            results.extend((r.get("result"), r.get("error")) for r in replies)
+        return results
+
+    def multi_or_raise(self, actions: list[dict]) -> list[Any]:
+        results = []
+        for action, (result, error) in zip(actions, self.multi(actions)):
+            if error:
+                raise AnkiConnectError(f"{action['action']}: {error}")
+            results.append(result)
+        return results
+
+
+def _fields_sha256(fields: list[str]) -> str:
+    return hashlib.sha256("\x1f".join(fields).encode()).hexdigest()
+
+
+def sync_people(
+    people: Iterable, client: AnkiConnect | None = None, profile: str = "full"
+) -> dict[str, int]:
+    """Bring Anki's copies of `people` up to date and return what was sent.
+
+    Only notes that were never synced, or whose fields changed since, are
+    sent. `people` is read twice. The caller commits.
+    """
+    client = client or AnkiConnect()
+    model = get_model()
+    synced = {
+        guid: (note_id, sha)
+        for guid, note_id, sha in db.session.execute(
+            db.select(SyncedNote.guid, SyncedNote.note_id, SyncedNote.fields_sha256)
+        )
+    }
+
+    have_media = already_exported_media(people, profile)
+    needed_media: set[str] = set()
+    # (guid, person row, fields, fields hash, Anki note id if known)
+    changes: list[tuple[str, Any, list[str], str, int | None]] = []
+    unchanged = 0
+    for person in people:
+        if person.face_filename and person.face_filename not in have_media:
+            needed_media.add(person.face_filename)
+        guid, fields = person_note(person)
+        sha = _fields_sha256(fields)
+        note_id, synced_sha = synced.get(guid, (None, None))
+        if sha == synced_sha:
+            unchanged += 1
+        else:
+            changes.append((guid, person, fields, sha, note_id))
+
+    needs_lookup = any(note_id is None for *_, note_id in changes)
+    if needs_lookup:
+        _check_untagged_notes(client, model)
+    _ensure_model(client, model)
+    media_files, media_bytes = _push_media(client, sorted(needed_media), profile)
+
+    if needs_lookup:
+        tagged = _find_tagged_notes(client, model)
+        changes = [
+            (guid, person, fields, sha, note_id or tagged.get(guid_tag(guid)))
+            for guid, person, fields, sha, note_id in changes
+        ]
+
+    added, updated = _push_notes(client, model, changes)
+    return {
+        "notes_added": added,
+        "notes_updated": updated,
+        "notes_unchanged": unchanged,
+        "media_files": media_files,
+        "media_bytes": media_bytes,
+    }
+
+
+def _ensure_model(client: AnkiConnect, model: genanki.Model) -> None:
+    """Refresh the card templates of the note type in Anki, if it has it.
+
+    A missing note type (and deck) arrives with the first imported package,
+    under MODEL_ID; createModel would pick an id packages don't match.
+    """
+    model_id = client.invoke("modelNamesAndIds").get(model.name)
+    if model_id is None:
+        return
+    if model_id != MODEL_ID:
+        raise AnkiConnectError(
+            f"Anki's {model.name} note type wasn't created from one of this app's"
+            " packages, so importing one would add a second note type and"
+            " duplicate its notes. Rename or delete it in Anki, import a full"
+            " export, then sync."
+        )
+    templates = {
+        t["name"]: {"Front": t["qfmt"], "Back": t["afmt"]} for t in model.templates
+    }
+    client.multi_or_raise(
+        [
+            _action(
+                "updateModelTemplates",
+                model={"name": model.name, "templates": templates},
+            ),
+            _action("updateModelStyling", model={"name": model.name, "css": model.css}),
+        ]
+    )
+
+
+def _push_media(
+    client: AnkiConnect, filenames: list[str], profile: str
+) -> tuple[int, int]:
+    """Store media files in Anki, a few megabytes per request."""
+    files_sent = 0
+    bytes_sent = 0
+    batch: list[str] = []
+    actions: list[dict] = []
+    batch_bytes = 0
+
+    def flush() -> None:
+        client.multi_or_raise(actions)
+        record_media(batch, profile)
+        batch.clear()
+        actions.clear()
+
+    for filename in filenames:
+        path = export_media_path(filename, profile)
+        if path is None:
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        encoded = base64.b64encode(data).decode()
+        batch.append(filename)
+        actions.append(_action("storeMediaFile", filename=filename, data=encoded))
+        files_sent += 1
+        bytes_sent += len(data)
+        batch_bytes += len(encoded)
+        if batch_bytes >= _MEDIA_BATCH_BYTES:
+            flush()
+            batch_bytes = 0
+    if actions:
+        flush()
+    return files_sent, bytes_sent
+
+
+def _check_untagged_notes(client: AnkiConnect, model: genanki.Model) -> None:
+    """Refuse to sync while Anki has notes of ours that can't be matched.
+
+    Notes are matched by GUID tag, which packages only carry since syncing
+    was added. Notes imported from an older package would be added again.
+    """
+    query = f'"note:{model.name}" -"tag:{GUID_TAG_PREFIX}*"'
+    untagged = client.invoke("findNotes", query=query)
+    if untagged:
+        raise AnkiConnectError(
+            f"{len(untagged)} {model.name} notes in Anki were imported from a"
+            " package too old to be matched, and syncing would duplicate them."
+            " Export a full package and import it into Anki first, then sync."
+        )
+
+
+def _find_tagged_notes(client: AnkiConnect, model: genanki.Model) -> dict[str, int]:
+    """Map GUID tags to Anki note ids, for notes this app put into Anki."""
+    query = f'"note:{model.name}" "tag:{GUID_TAG_PREFIX}*"'
+    note_ids = client.invoke("findNotes", query=query)
+    found: dict[str, int] = {}
+    for batch in itertools.batched(note_ids, _NOTES_INFO_BATCH_SIZE):
+        for info in client.invoke("notesInfo", notes=list(batch)):
+            for tag in info.get("tags", []):
+                if tag.startswith(GUID_TAG_PREFIX):
+                    found[tag] = info["noteId"]
+    return found
+
+
+def _push_notes(
+    client: AnkiConnect,
+    model: genanki.Model,
+    changes: list[tuple[str, Any, list[str], str, int | None]],
+) -> tuple[int, int]:
+    """Update or add notes in Anki and remember what was sent.
+
+    Notes Anki has are updated in place. The rest, including notes deleted in
+    Anki since they were synced, are imported from a package.
+    """
+    field_names = [f["name"] for f in model.fields]
+    updates = [c for c in changes if c[4] is not None]
+    additions = [c for c in changes if c[4] is None]
+    actions = [
+        _action(
+            "updateNoteFields",
+            note={"id": note_id, "fields": dict(zip(field_names, fields))},
+        )
+        for _, _, fields, _, note_id in updates
+    ]
+    synced_rows = []
+    for change, (_, error) in zip(updates, client.multi(actions)):
+        guid, person, _, sha, note_id = change
+        if error:
+            additions.append(change)
+        else:
+            synced_rows.append((guid, person.id, note_id, sha))
+    updated = len(synced_rows)
+
+    if additions:
+        note_ids = _import_notes(client, model, [c[1] for c in additions])
+        for guid, person, _, sha, _ in additions:
+            note_id = note_ids.get(guid_tag(guid))
+            if note_id is None:
+                raise AnkiConnectError(f"importPackage: note {guid} was not added")
+            synced_rows.append((guid, person.id, note_id, sha))
+
+    _record_synced(synced_rows)
+    return len(additions), updated
+
+
+def _import_notes(
+    client: AnkiConnect, model: genanki.Model, people: list
+) -> dict[str, int]:
+    """Add `people`'s notes to Anki from a package; return _find_tagged_notes.
+
+    Their photos are left out of the package, as _push_media already sent them.
+    """
+    photos = {p.face_filename for p in people if p.face_filename}
+    with tempfile.TemporaryDirectory(prefix="names-and-faces-sync-") as scratch:
+        path = os.path.join(scratch, "notes.apkg")
+        generate_deck(people, path, exclude_media=photos)
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode()
+    # Sent as data rather than a path, so Anki can be on another machine.
+    client.invoke("storeMediaFile", filename=_IMPORT_PACKAGE_NAME, data=data)
+    try:
+        if not client.invoke("importPackage", path=_IMPORT_PACKAGE_NAME):
+            raise AnkiConnectError("importPackage: Anki could not import the notes")
+    finally:
+        client.invoke("deleteMediaFile", filename=_IMPORT_PACKAGE_NAME)
+    return _find_tagged_notes(client, model)
+
+
+def _record_synced(rows: list[tuple[str, str, int | None, str]]) -> None:
+    now = datetime.now(timezone.utc)
+    values = (
+        {
+            "guid": guid,
+            "person_id": person_id,
+            "note_id": note_id,
+            "fields_sha256": sha,
+            "synced_at": now,
+        }
+        for guid, person_id, note_id, sha in rows
+    )
+    for batch in itertools.batched(values, _UPSERT_BATCH_SIZE):
+        stmt = insert(SyncedNote)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SyncedNote.guid],
+            set_={
+                "person_id": stmt.excluded.person_id,
+                "note_id": stmt.excluded.note_id,
+                "fields_sha256": stmt.excluded.fields_sha256,
+                "synced_at": now,
+            },
+        )
+        db.session.execute(stmt, list(batch))
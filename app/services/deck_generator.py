@@ -1,14 +1,92 @@
+import hashlib
 import html
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any
 
 import genanki
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
 
-from app import MEDIA_DIR
+from app import CACHE_DIR, MEDIA_DIR, db
+from app.models import Person, TemplateVersion
+from app.services.export_metrics import ExportMetrics
+from app.services.images import EXPORT_PROFILES, export_media_path
 
 _TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "card_templates")
+_TEMPLATE_FILES = ("card.html", "style.css")
+
+DECK_CACHE_DIR = os.path.join(CACHE_DIR, "decks")
+DECK_CACHE_KEEP = 5
+# A package being built is written to continuously, so a partial one that
+# hasn't changed for this long was left by a build that was killed.
+_STALE_BUILD_SECONDS = 10 * 60
 
 MODEL_ID = 1704067337
 DECK_ID = 1704067338
+DECK_NAME = "Names and Faces"
+GUID_TAG_PREFIX = "nf::"
+
+# Ways an export can be split into sub-decks: by the person's source, or by
+# the first letter of their name.
+SPLIT_MODES = {"source", "letter"}
+
+# Bump when the package contents change for the same input, so cached decks
+# built by older code are not reused.
+PACKAGE_FORMAT = 3
+
+# Bump when person_fields or person_guid change, so stored notes are rendered
+# again at startup.
+NOTE_FORMAT_VERSION = 1
+
+_INSERT_BATCH_SIZE = 1000
+_REFRESH_BATCH_SIZE = 1000
+# Below this many notes, sub-decks are built in-process; spawning workers
+# costs more than it saves.
+_SHARD_PARALLEL_MIN_NOTES = 20_000
+# Media formats that are already compressed; deflating them again costs CPU
+# for next to no size gain, so they go into the package as-is.
+_STORED_MEDIA_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+# Media files are read from a thread pool while the zip is written; at most
+# _MEDIA_READ_AHEAD files are held in memory at once.
+_MEDIA_READ_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+_MEDIA_READ_AHEAD = 64
+# Zip timestamps can't predate 1980.
+_ZIP_EPOCH = 315532800
+# genanki's schema split so the indexes can be built once after the bulk insert
+# rather than maintained row by row.
+_SCHEMA_STATEMENTS = [stmt.strip() for stmt in APKG_SCHEMA.split(";") if stmt.strip()]
+_SCHEMA_TABLES = [s for s in _SCHEMA_STATEMENTS if not s.startswith("CREATE INDEX")]
+_SCHEMA_INDEXES = [s for s in _SCHEMA_STATEMENTS if s.startswith("CREATE INDEX")]
+# type, queue, due, ivl, factor, reps, lapses, left, odue, odid, flags, data
+# for a new, unsuspended card.
+_CARD_ROW_DEFAULTS = (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, "")
+
+# (template file stats, template content hash, model), rebuilt whenever a
+# template file's mtime or size changes.
+_model_cache: tuple[tuple[tuple[int, int], ...], str, genanki.Model] | None = None
+_model_lock = threading.Lock()
+# (template content hash, when it came into use as a Unix timestamp), cleared
+# whenever the model is rebuilt.
+_template_current: tuple[str, float] | None = None
+
+# Called with (notes written, media bytes packed) as a package is built.
+ProgressCallback = Callable[[int, int], None]
 
 
 def _load_template(name: str) -> str:
@@ -69,6 +147,91 @@ def _build_model() -> genanki.Model:
     )
 
 
+def _template_stats() -> tuple[tuple[int, int], ...]:
+    stats = (os.stat(os.path.join(_TEMPLATE_DIR, n)) for n in _TEMPLATE_FILES)
+    return tuple((st.st_mtime_ns, st.st_size) for st in stats)
+
+
+def _cached_model() -> tuple[str, genanki.Model]:
+    global _model_cache, _template_current
+
+    stats = _template_stats()
+    cached = _model_cache
+    if cached is not None and cached[0] == stats:
+        return cached[1], cached[2]
+
+    with _model_lock:
+        cached = _model_cache
+        if cached is None or cached[0] != stats:
+            h = hashlib.sha256()
+            for name in _TEMPLATE_FILES:
+                h.update(_load_template(name).encode())
+                h.update(b"\0")
+            model = _build_model()
+            # Computing which fields each card needs renders every template;
+            # do it once here rather than on the first note of each export.
+            model._req  # noqa: B018
+            cached = _model_cache = (stats, h.hexdigest(), model)
+            _template_current = None
+    return cached[1], cached[2]
+
+
+def get_model() -> genanki.Model:
+    """Return the card model, rebuilt only when the template files change."""
+    return _cached_model()[1]
+
+
+def template_hash() -> str:
+    """Return a hash of the card template and CSS contents."""
+    return _cached_model()[0]
+
+
+def template_timestamp() -> float:
+    """Return when the current card templates came into use.
+
+    Stands in for the template files' mtimes, which a fresh checkout or
+    reinstall resets. It is stored in the database, so it travels with the
+    data it stamps. Switching back to an earlier version counts as a change
+    of its own, so the stamp never goes backwards; Anki only takes a note type
+    that is newer than the one it has.
+
+    A change is recorded in a transaction of its own, committed at once, so an
+    export never holds the write lock while it builds. create_app records the
+    templates it starts with. If the database is busy, the change is stamped
+    with the current time and recorded next time.
+    """
+    global _template_current
+
+    digest = template_hash()
+    current = _template_current
+    if current is not None and current[0] == digest:
+        return current[1]
+    latest = db.session.execute(
+        db.select(TemplateVersion.sha256, TemplateVersion.current_since)
+        .order_by(TemplateVersion.current_since.desc())
+        .limit(1)
+    ).first()
+    if latest is not None and latest.sha256 == digest:
+        # Stored as naive UTC.
+        since = latest.current_since.replace(tzinfo=timezone.utc)
+    else:
+        since = datetime.now(timezone.utc)
+        stmt = insert(TemplateVersion).values(sha256=digest, current_since=since)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[TemplateVersion.sha256],
+            set_={"current_since": since},
+        )
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(stmt)
+        except OperationalError as e:
+            if getattr(e.orig, "sqlite_errorcode", None) != sqlite3.SQLITE_BUSY:
+                raise
+            return since.timestamp()
+    _template_current = (digest, since.timestamp())
+    return _template_current[1]
+
+
 class PersonNote(genanki.Note):
     """Note subclass with a stable GUID based on the person's database UUID.
 
@@ -78,11 +241,27 @@ class PersonNote(genanki.Note):
 
     def __init__(self, person_id: str, **kwargs: object) -> None:
         self._person_id = person_id
+        kwargs.setdefault("tags", [guid_tag(person_guid(person_id))])
         super().__init__(**kwargs)
 
     @property
     def guid(self) -> str:
-        return genanki.guid_for(self._person_id)
+        return person_guid(self._person_id)
+
+
+def person_guid(person_id: str) -> str:
+    """Return the stable Anki note GUID for a person."""
+    return genanki.guid_for(person_id)
+
+
+def guid_tag(guid: str) -> str:
+    """Return the tag that carries a note's GUID into Anki.
+
+    Anki can't search by GUID, so the tag is how a sync finds notes that were
+    imported from a package. GUIDs contain characters that are special in
+    Anki searches, hence the hex encoding.
+    """
+    return GUID_TAG_PREFIX + guid.encode().hex()
 
 
 def _make_face_html(face_filename: str | None) -> str:
@@ -91,48 +270,623 @@ def _make_face_html(face_filename: str | None) -> str:
     return f'<img src="{html.escape(face_filename)}">'
 
 
-def generate_deck(people: list, output_path: str) -> None:
-    model = _build_model()
-    deck = genanki.Deck(DECK_ID, "Names and Faces")
-    media_files: list[str] = []
+def person_fields(person) -> list[str]:  # type: ignore[no-untyped-def]
+    """Render a person into the Names and Faces model's field values."""
+    face_html = _make_face_html(person.face_filename)
+    name_val = html.escape(person.name) if person.name else ""
+    ctx_val = html.escape(person.context) if person.context else ""
 
-    for person in people:
-        face_html = _make_face_html(person.face_filename)
-        name_val = html.escape(person.name) if person.name else ""
-        ctx_val = html.escape(person.context) if person.context else ""
-
-        has_face = bool(person.face_filename)
-        has_context = person.has_context()
-
-        toggle_face_to_name = "1" if (person.card_face_to_name and has_face) else ""
-        toggle_name_to_face = "1" if person.card_name_to_face else ""
-        toggle_nf_to_ctx = (
-            "1"
-            if (person.card_name_face_to_context and has_face and has_context)
-            else ""
+    has_face = bool(person.face_filename)
+    has_context = bool(person.context and person.context.strip())
+
+    toggle_face_to_name = "1" if (person.card_face_to_name and has_face) else ""
+    toggle_name_to_face = "1" if person.card_name_to_face else ""
+    toggle_nf_to_ctx = (
+        "1" if (person.card_name_face_to_context and has_face and has_context) else ""
+    )
+    toggle_ctx_to_person = (
+        "1" if (person.card_context_to_person and has_context) else ""
+    )
+
+    return [
+        name_val,
+        face_html,
+        ctx_val,
+        toggle_face_to_name,
+        toggle_name_to_face,
+        toggle_nf_to_ctx,
+        toggle_ctx_to_person,
+    ]
+
+
+def render_note(person: Person) -> None:
+    """Store the person's note GUID and fields on the row, ready for export."""
+    person.note_guid = person_guid(person.id)
+    person.note_fields = "\x1f".join(person_fields(person))
+    person.note_version = NOTE_FORMAT_VERSION
+
+
+def person_note(person) -> tuple[str, list[str]]:  # type: ignore[no-untyped-def]
+    """Return a person's note GUID and fields, from the stored copy if current."""
+    if person.note_version == NOTE_FORMAT_VERSION:
+        return person.note_guid, person.note_fields.split("\x1f")
+    return person_guid(person.id), person_fields(person)
+
+
+def refresh_note_fields() -> int:
+    """Render the stored notes that are missing or out of date; return how many.
+
+    Rows written before notes were stored, or by an older NOTE_FORMAT_VERSION,
+    are updated in place without touching updated_at, so nothing looks edited.
+    They are read a page at a time in id order and each page is committed, so
+    memory stays bounded however many rows are out of date.
+    """
+    people = Person.__table__
+    stale = db.select(
+        Person.id,
+        Person.name,
+        Person.context,
+        Person.face_filename,
+        Person.card_face_to_name,
+        Person.card_name_to_face,
+        Person.card_name_face_to_context,
+        Person.card_context_to_person,
+    ).where(
+        db.or_(
+            people.c.note_version.is_(None),
+            people.c.note_version != NOTE_FORMAT_VERSION,
+        )
+    )
+    stmt = (
+        db.update(people)
+        .where(people.c.id == db.bindparam("person_id"))
+        .values(
+            note_guid=db.bindparam("guid"),
+            note_fields=db.bindparam("fields"),
+            note_version=NOTE_FORMAT_VERSION,
+            updated_at=people.c.updated_at,
         )
-        toggle_ctx_to_person = (
-            "1" if (person.card_context_to_person and has_context) else ""
+    )
+    refreshed = 0
+    last_id = ""
+    while True:
+        batch = db.session.execute(
+            stale.where(Person.id > last_id)
+            .order_by(Person.id)
+            .limit(_REFRESH_BATCH_SIZE)
+        ).all()
+        if not batch:
+            return refreshed
+        db.session.execute(
+            stmt,
+            [
+                {
+                    "person_id": p.id,
+                    "guid": person_guid(p.id),
+                    "fields": "\x1f".join(person_fields(p)),
+                }
+                for p in batch
+            ],
+        )
+        db.session.commit()
+        refreshed += len(batch)
+        last_id = batch[-1].id
+
+
+def generate_deck(
+    people: Iterable,
+    output_path: str,
+    exclude_media: set[str] | None = None,
+    on_progress: ProgressCallback | None = None,
+    split_by: str | None = None,
+    profile: str = "full",
+    timestamp: float | None = None,
+    metrics: ExportMetrics | None = None,
+) -> set[str]:
+    """Write an .apkg for `people` to `output_path`.
+
+    Media files named in `exclude_media` are referenced by their notes but left
+    out of the package, for importing into a collection that already has them.
+    `on_progress` is called after each batch of notes and each media file.
+    With `split_by` set to one of SPLIT_MODES, notes go into sub-decks of the
+    main deck, built in parallel worker processes for large collections.
+    Photos are re-encoded according to `profile`, one of EXPORT_PROFILES.
+
+    `timestamp` (default: now) stamps the collection and the zip entries;
+    given the same one, the same input produces byte-identical packages.
+    Stage timings are added to `metrics`.
+
+    Returns the media filenames the notes refer to, packaged or not.
+    """
+    exclude_media = exclude_media or set()
+    metrics = metrics or ExportMetrics()
+    model = get_model()
+    available_media = _list_media()
+    media_files: list[str] = []
+    # People who share a photo share its file; it's packaged once.
+    referenced: set[str] = set()
+
+    def notes() -> Iterator[tuple[Any, tuple[str, list[str]]]]:
+        for person in metrics.timed_rows(people, "load"):
+            filename = person.face_filename
+            if filename and filename not in referenced:
+                referenced.add(filename)
+                if filename not in exclude_media and filename in available_media:
+                    media_files.append(filename)
+            yield person, person_note(person)
+
+    # The collection is written before the zip, so media_files is complete by
+    # the time the media entries are added.
+    if split_by:
+
+        def write(conn: sqlite3.Connection, timestamp: float) -> int:
+            shards: dict[str, list[tuple[str, list[str]]]] = {}
+            for person, note in notes():
+                shard = _shard_name(person, split_by)
+                shards.setdefault(shard, []).append(note)
+            return _write_sharded_collection(
+                conn, model, shards, timestamp, on_progress
+            )
+
+    else:
+
+        def write(conn: sqlite3.Connection, timestamp: float) -> int:
+            guid_notes = (note for _, note in notes())
+            return _write_collection(conn, model, guid_notes, timestamp, on_progress)
+
+    _write_package(
+        write,
+        media_files,
+        output_path,
+        time.time() if timestamp is None else timestamp,
+        on_progress,
+        profile,
+        metrics,
+    )
+    return referenced
+
+
+def _shard_name(person, split_by: str) -> str:  # type: ignore[no-untyped-def]
+    if split_by == "source":
+        return (person.source or "manual").capitalize()
+    first = next((c for c in (person.name or "") if c.isalnum()), "")
+    return first.upper() if first.isalpha() else "#"
+
+
+def _shard_deck_id(name: str) -> int:
+    """Return a stable deck id for a sub-deck, so re-imports reuse the deck."""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:6], "big")
+
+
+def _write_package(
+    write_collection: Callable[[sqlite3.Connection, float], int],
+    media_files: list[str],
+    output_path: str,
+    timestamp: float,
+    on_progress: ProgressCallback | None = None,
+    profile: str = "full",
+    metrics: ExportMetrics | None = None,
+) -> None:
+    """Write an .apkg with the same layout as genanki's Package.write_to_file.
+
+    `write_collection` fills the collection database and returns the number
+    of notes it wrote. `media_files` are names in MEDIA_DIR; each is packaged
+    under its own name so the notes' <img> tags still resolve, with the bytes
+    of its `profile` derivative. Unlike genanki, which stores every entry
+    uncompressed, the collection database is deflated while already-compressed
+    images are stored.
+
+    Entries go in a fixed order, and every entry is dated `timestamp` with
+    fixed attributes, so nothing about the build environment (file mtimes,
+    umask, OS) leaks into the bytes.
+
+    genanki builds the collection database in a mkstemp() file that it never
+    deletes, leaking one file per export. Build it in a scratch directory that
+    is removed as soon as the zip is written instead.
+    """
+    metrics = metrics or ExportMetrics()
+    # Rows are fetched lazily while notes are written, and media reads are
+    # waited on while the zip is written; the "load" and "media" time is
+    # taken out of the enclosing stage so the stages add up.
+    load = metrics.get("load")
+    media = metrics.get("media")
+    with tempfile.TemporaryDirectory(prefix="names-and-faces-") as scratch:
+        db_path = os.path.join(scratch, "collection.anki2")
+        conn = sqlite3.connect(db_path)
+        with metrics.stage("notes") as stage:
+            load_before = load.seconds
+            try:
+                notes_written = write_collection(conn, timestamp)
+                conn.commit()
+            finally:
+                conn.close()
+            stage.items = notes_written
+            stage.bytes = os.path.getsize(db_path)
+        stage.seconds -= load.seconds - load_before
+
+        date_time = time.gmtime(max(timestamp, _ZIP_EPOCH))[:6]
+        with metrics.stage("zip") as stage:
+            media_before = media.seconds
+            with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as outzip:
+                zinfo = _zip_entry("collection.anki2", date_time, zipfile.ZIP_DEFLATED)
+                with open(db_path, "rb") as src, outzip.open(zinfo, "w") as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                media_json = dict(enumerate(media_files))
+                zinfo = _zip_entry("media", date_time, zipfile.ZIP_DEFLATED)
+                outzip.writestr(zinfo, json.dumps(media_json))
+                entries = _read_media(media_files, profile, date_time)
+                for zinfo, data in metrics.timed_rows(entries, "media"):
+                    outzip.writestr(zinfo, data)
+                    media.bytes += len(data)
+                    if on_progress:
+                        on_progress(notes_written, media.bytes)
+            stage.items = len(media_files) + 2
+        stage.seconds -= media.seconds - media_before
+        stage.bytes = os.path.getsize(output_path)
+
+
+def _zip_entry(
+    name: str, date_time: tuple[int, ...], compress_type: int
+) -> zipfile.ZipInfo:
+    zinfo = zipfile.ZipInfo(name, date_time)  # type: ignore[arg-type]
+    zinfo.compress_type = compress_type
+    zinfo.create_system = 3
+    zinfo.external_attr = 0o644 << 16
+    return zinfo
+
+
+def _list_media() -> set[str]:
+    """Return the names of all files in MEDIA_DIR from a single directory scan."""
+    try:
+        with os.scandir(MEDIA_DIR) as entries:
+            return {e.name for e in entries if e.is_file()}
+    except FileNotFoundError:
+        return set()
+
+
+def _read_media_entry(
+    filename: str, arcname: str, profile: str, date_time: tuple[int, ...]
+) -> tuple[zipfile.ZipInfo, bytes]:
+    # Resolving the derivative may encode it, so it happens on the worker too.
+    path = export_media_path(filename, profile) or os.path.join(MEDIA_DIR, filename)
+    zinfo = _zip_entry(arcname, date_time, _media_compress_type(path))
+    with open(path, "rb") as f:
+        return zinfo, f.read()
+
+
+def _read_media(
+    media_files: list[str], profile: str, date_time: tuple[int, ...]
+) -> Iterator[tuple[zipfile.ZipInfo, bytes]]:
+    """Yield zip entries for `media_files` in order, read concurrently."""
+    with ThreadPoolExecutor(max_workers=_MEDIA_READ_WORKERS) as pool:
+        pending: deque[Future[tuple[zipfile.ZipInfo, bytes]]] = deque()
+        for idx, filename in enumerate(media_files):
+            pending.append(
+                pool.submit(_read_media_entry, filename, str(idx), profile, date_time)
+            )
+            if len(pending) >= _MEDIA_READ_AHEAD:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _media_compress_type(path: str) -> int:
+    ext = os.path.splitext(path)[1].lower()
+    return (
+        zipfile.ZIP_STORED if ext in _STORED_MEDIA_EXTENSIONS else zipfile.ZIP_DEFLATED
+    )
+
+
+def _write_collection(
+    conn: sqlite3.Connection,
+    model: genanki.Model,
+    notes: Iterable[tuple[str, list[str]]],
+    timestamp: float,
+    on_progress: ProgressCallback | None = None,
+) -> int:
+    """Fill an empty collection database with `notes` as (guid, fields) pairs.
+
+    Returns the number of notes written.
+
+    Produces the same rows genanki's Note/Card objects would, but inserts them
+    with executemany in batches instead of one statement per row. Note and
+    card ids come from one counter seeded with the timestamp, as in genanki.
+    """
+    cursor = conn.cursor()
+    _create_collection(cursor, model, {DECK_ID: DECK_NAME}, timestamp)
+    ids = itertools.count(int(timestamp * 1000))
+    notes_written = _insert_notes(
+        cursor, model, notes, DECK_ID, int(timestamp), ids, on_progress
+    )
+    for stmt in _SCHEMA_INDEXES:
+        cursor.execute(stmt)
+    return notes_written
+
+
+def _create_collection(
+    cursor: sqlite3.Cursor,
+    model: genanki.Model,
+    decks: dict[int, str],
+    timestamp: float,
+) -> None:
+    """Create genanki's schema (minus indexes) with `decks` and the model."""
+    cursor.execute("PRAGMA journal_mode = OFF")
+    cursor.execute("PRAGMA synchronous = OFF")
+    for stmt in _SCHEMA_TABLES:
+        cursor.execute(stmt)
+    cursor.executescript(APKG_COL)
+
+    (decks_json,) = cursor.execute("SELECT decks FROM col").fetchone()
+    all_decks = json.loads(decks_json)
+    for deck_id, name in decks.items():
+        all_decks[str(deck_id)] = genanki.Deck(deck_id, name).to_json()
+    (models_json,) = cursor.execute("SELECT models FROM col").fetchone()
+    models = json.loads(models_json)
+    models[str(MODEL_ID)] = model.to_json(timestamp, DECK_ID)
+    cursor.execute(
+        "UPDATE col SET decks = ?, models = ?",
+        (json.dumps(all_decks), json.dumps(models)),
+    )
+
+
+def _insert_notes(
+    cursor: sqlite3.Cursor,
+    model: genanki.Model,
+    notes: Iterable[tuple[str, list[str]]],
+    deck_id: int,
+    mod: int,
+    ids: Iterator[int],
+    on_progress: ProgressCallback | None = None,
+) -> int:
+    # Same rule genanki applies per note: a card exists for each template
+    # whose required fields are non-empty.
+    card_reqs = [
+        (card_ord, any if kind == "any" else all, field_ords)
+        for card_ord, kind, field_ords in model._req
+    ]
+
+    notes_written = 0
+    for batch in itertools.batched(notes, _INSERT_BATCH_SIZE):
+        note_rows = []
+        card_rows = []
+        for guid, fields in batch:
+            note_id = next(ids)
+            tags = f" {guid_tag(guid)} "
+            note_rows.append(
+                (note_id, guid, MODEL_ID, mod, -1, tags, "\x1f".join(fields))
+                + (fields[0], 0, 0, "")
+            )
+            for card_ord, op, field_ords in card_reqs:
+                if op(fields[i] for i in field_ords):
+                    card_rows.append(
+                        (next(ids), note_id, deck_id, card_ord, mod, -1)
+                        + _CARD_ROW_DEFAULTS
+                    )
+        cursor.executemany("INSERT INTO notes VALUES(?,?,?,?,?,?,?,?,?,?,?)", note_rows)
+        cursor.executemany(
+            "INSERT INTO cards VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", card_rows
         )
+        notes_written += len(note_rows)
+        if on_progress:
+            on_progress(notes_written, 0)
+    return notes_written
+
+
+def _build_shard(
+    db_path: str, deck_id: int, notes: list[tuple[str, list[str]]], mod: int
+) -> int:
+    """Write one sub-deck's notes and cards to their own database.
+
+    Runs in a worker process. Ids start at 0 and are offset when the shard is
+    merged. Returns the highest id used.
+    """
+    model = get_model()
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode = OFF")
+        cursor.execute("PRAGMA synchronous = OFF")
+        for stmt in _SCHEMA_TABLES:
+            cursor.execute(stmt)
+        ids = itertools.count()
+        _insert_notes(cursor, model, notes, deck_id, mod, ids)
+        conn.commit()
+    finally:
+        conn.close()
+    return next(ids) - 1
 
-        fields = [
-            name_val,
-            face_html,
-            ctx_val,
-            toggle_face_to_name,
-            toggle_name_to_face,
-            toggle_nf_to_ctx,
-            toggle_ctx_to_person,
+
+def _write_sharded_collection(
+    conn: sqlite3.Connection,
+    model: genanki.Model,
+    shards: dict[str, list[tuple[str, list[str]]]],
+    timestamp: float,
+    on_progress: ProgressCallback | None = None,
+) -> int:
+    """Fill a collection with one sub-deck per shard of (guid, fields) pairs.
+
+    Each shard is written to its own database, in a process pool when the
+    collection is big enough to be worth it, and the shards are then copied
+    into the collection with their ids offset past the previous shard's.
+    """
+    cursor = conn.cursor()
+    deck_ids = {name: _shard_deck_id(f"{DECK_NAME}::{name}") for name in sorted(shards)}
+    decks = {DECK_ID: DECK_NAME}
+    decks.update({deck_ids[name]: f"{DECK_NAME}::{name}" for name in deck_ids})
+    _create_collection(cursor, model, decks, timestamp)
+
+    with tempfile.TemporaryDirectory(prefix="names-and-faces-shards-") as shard_dir:
+        mod = int(timestamp)
+        jobs = [
+            (os.path.join(shard_dir, f"{i}.anki2"), deck_ids[name], shards[name], mod)
+            for i, name in enumerate(deck_ids)
         ]
 
-        note = PersonNote(person_id=person.id, model=model, fields=fields)
-        deck.add_note(note)
+        total = sum(len(notes) for notes in shards.values())
+        workers = min(len(jobs), os.cpu_count() or 1)
+        if total >= _SHARD_PARALLEL_MIN_NOTES and workers > 1:
+            # spawn rather than fork: exports run inside a threaded web server.
+            # Workers import the main module again, so entry points must only
+            # create the app under `if __name__ == "__main__"`.
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                max_ids = list(pool.map(_build_shard, *zip(*jobs)))
+        else:
+            max_ids = [_build_shard(*job) for job in jobs]
+
+        offset = int(timestamp * 1000)
+        notes_written = 0
+        for (path, _, notes, _), max_id in zip(jobs, max_ids):
+            cursor.execute("ATTACH DATABASE ? AS shard", (path,))
+            cursor.execute(
+                "INSERT INTO notes SELECT id + ?, guid, mid, mod, usn, tags, flds,"
+                " sfld, csum, flags, data FROM shard.notes",
+                (offset,),
+            )
+            cursor.execute(
+                "INSERT INTO cards SELECT id + ?, nid + ?, did, ord, mod, usn, type,"
+                " queue, due, ivl, factor, reps, lapses, left, odue, odid, flags,"
+                " data FROM shard.cards",
+                (offset, offset),
+            )
+            conn.commit()
+            cursor.execute("DETACH DATABASE shard")
+            offset += max_id + 1
+            notes_written += len(notes)
+            if on_progress:
+                on_progress(notes_written, 0)
+
+    for stmt in _SCHEMA_INDEXES:
+        cursor.execute(stmt)
+    return notes_written
+
+
+def deck_digest(
+    people: Iterable,
+    exclude_media: set[str] | None = None,
+    split_by: str | None = None,
+    profile: str = "full",
+) -> tuple[str, float, set[str]]:
+    """Hash everything that ends up in the exported package.
 
+    Covers the exported person rows and the card template/CSS contents, so a
+    matching digest means a previously built package can be reused as-is.
+    Media files are named uniquely and never rewritten, so their filenames
+    stand in for their contents.
+
+    Also returns the timestamp to build the package with: the latest edit to
+    the rows, or when the current templates came into use. It is newer than
+    any earlier export's whenever something changed, which Anki needs to take
+    the update, and is otherwise fixed, so the same input always builds the
+    same bytes. Lastly returns the media filenames the rows refer to.
+    """
+    latest = template_timestamp()
+    filenames: set[str] = set()
+    h = hashlib.sha256()
+    # The templates' timestamp too: reverting them stamps the package anew.
+    h.update(f"{template_hash()}@{latest!r}".encode())
+    h.update(f"format={PACKAGE_FORMAT}".encode())
+    h.update(f"split={split_by or ''}".encode())
+    h.update(f"profile={profile}:{EXPORT_PROFILES.get(profile)}".encode())
+    for person in people:
+        row = (
+            person.id,
+            person.name,
+            person.context or "",
+            person.card_face_to_name,
+            person.card_name_to_face,
+            person.card_name_face_to_context,
+            person.card_context_to_person,
+            person.face_filename or "",
+            person.source or "",
+            person.updated_at.isoformat() if person.updated_at else "",
+        )
+        h.update("\x1f".join(str(v) for v in row).encode())
+        h.update(b"\x1e")
         if person.face_filename:
-            media_path = os.path.join(MEDIA_DIR, person.face_filename)
-            if os.path.exists(media_path):
-                media_files.append(media_path)
+            filenames.add(person.face_filename)
+        if person.updated_at:
+            # Stored as naive UTC.
+            updated = person.updated_at.replace(tzinfo=timezone.utc).timestamp()
+            latest = max(latest, updated)
+    for filename in sorted(exclude_media or ()):
+        h.update(b"-" + filename.encode())
+    return h.hexdigest(), latest, filenames
 
-    package = genanki.Package(deck)
-    package.media_files = media_files
-    package.write_to_file(output_path)
+
+def build_cached_deck(
+    people: Iterable,
+    exclude_media: set[str] | None = None,
+    on_progress: ProgressCallback | None = None,
+    split_by: str | None = None,
+    profile: str = "full",
+    metrics: ExportMetrics | None = None,
+) -> tuple[str, set[str]]:
+    """Return a package for `people`, building it only on a cache miss.
+
+    Returns its path and the media filenames its notes refer to, taken from
+    the pass that produced the package (or, for a cached one, its key) rather
+    than from the rows as they are now.
+    """
+    metrics = metrics or ExportMetrics()
+    os.makedirs(DECK_CACHE_DIR, exist_ok=True)
+    with metrics.stage("digest"):
+        digest, timestamp, filenames = deck_digest(
+            people, exclude_media, split_by, profile
+        )
+    output_path = os.path.join(DECK_CACHE_DIR, f"{digest}.apkg")
+    if os.path.exists(output_path):
+        os.utime(output_path)
+        metrics.cached = True
+        return output_path, filenames
+
+    # Build under a unique name and rename into place, so a concurrent export
+    # never serves a half-written package.
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        filenames = generate_deck(
+            people,
+            tmp_path,
+            exclude_media,
+            on_progress,
+            split_by,
+            profile,
+            timestamp,
+            metrics,
+        )
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _prune_deck_cache()
+    return output_path, filenames
+
+
+def _prune_deck_cache(keep: int = DECK_CACHE_KEEP) -> None:
+    """Delete all but the `keep` most recently used cached packages.
+
+    Files already opened for sending stay readable after removal, so this is
+    safe to run while other requests are streaming cached decks. Partial
+    packages left by killed builds are deleted too.
+    """
+    entries = []
+    stale = []
+    cutoff = time.time() - _STALE_BUILD_SECONDS
+    for e in os.scandir(DECK_CACHE_DIR):
+        if not e.is_file():
+            continue
+        try:
+            mtime = e.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if e.name.endswith(".apkg"):
+            entries.append((mtime, e.path))
+        elif e.name.endswith(".tmp") and mtime < cutoff:
+            stale.append(e.path)
+    entries.sort(reverse=True)
+    for path in [p for _, p in entries[keep:]] + stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,126 @@
+"""Bookkeeping for what earlier exports already delivered to Anki.
+
+Anki keeps media it has imported once, so an "update" export can leave out
+photos whose exact bytes were shipped before, and a "changed" export can leave
+out people that have not been edited since the last export.
+"""
+
+import hashlib
+import itertools
+from collections.abc import Iterable
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects.sqlite import insert
+
+from app import db
+from app.models import ExportedMedia, ExportRecord
+from app.services.images import EXPORT_PROFILES, media_sha256
+
+_UPSERT_BATCH_SIZE = 1000
+
+
+def _face_filenames(people: Iterable) -> set[str]:
+    return {p.face_filename for p in people if p.face_filename}
+
+
+def shipped_media_sha256(filename: str, profile: str = "full") -> str | None:
+    """Return a hash identifying the bytes an export with `profile` ships for a file.
+
+    Worked out from the stored file's name and the profile's encoding, like
+    the derivative's own name, so no photo is read or re-encoded.
+    """
+    source_hash = media_sha256(filename)
+    spec = EXPORT_PROFILES.get(profile)
+    if source_hash is None or spec is None:
+        return source_hash
+    return hashlib.sha256(f"{source_hash}-{spec[0]}q{spec[1]}".encode()).hexdigest()
+
+
+def already_exported_media(people: Iterable, profile: str = "full") -> set[str]:
+    """Return the media filenames of `people` that Anki already has unchanged.
+
+    Compares against what `profile` would ship, so switching profiles sends
+    the photos again.
+    """
+    filenames = _face_filenames(people)
+    if not filenames:
+        return set()
+
+    # Scan the whole table rather than filtering with IN, which would need one
+    # bound parameter per selected photo.
+    rows = db.session.execute(db.select(ExportedMedia.filename, ExportedMedia.sha256))
+    return {
+        name
+        for name, sha in rows
+        if name in filenames and sha == shipped_media_sha256(name, profile)
+    }
+
+
+def last_full_export_time() -> datetime | None:
+    """Return when the last export covering the whole collection started."""
+    record = (
+        ExportRecord.query.filter_by(partial=False)
+        .order_by(ExportRecord.started_at.desc())
+        .first()
+    )
+    return record.started_at if record else None
+
+
+class PendingExport:
+    """An export that has been built but not yet handed to the user.
+
+    Holds what recording it needs (the photos the package's notes refer to,
+    and how many people it covers), so that it can be recorded after the
+    selection is gone, such as when a background job's package is finally
+    downloaded. Until then the export doesn't move the "changed" baseline or
+    mark its photos as shipped.
+    """
+
+    def __init__(
+        self,
+        filenames: set[str],
+        person_count: int,
+        mode: str,
+        started_at: datetime,
+        partial: bool = False,
+        profile: str = "full",
+    ) -> None:
+        self.mode = mode
+        self.started_at = started_at
+        self.partial = partial
+        self.profile = profile
+        self.person_count = person_count
+        self.filenames = filenames
+
+    def record(self) -> None:
+        """Remember the export, along with its media. The caller commits.
+
+        `started_at` should be taken before the people were queried, so that
+        edits racing with the export are picked up by the next delta export.
+        """
+        record_media(self.filenames, self.profile)
+        db.session.add(
+            ExportRecord(
+                started_at=self.started_at,
+                mode=self.mode,
+                partial=self.partial,
+                person_count=self.person_count,
+            )
+        )
+
+
+def record_media(filenames: Iterable[str], profile: str = "full") -> None:
+    """Remember that Anki now has the `profile` version of these media files."""
+    now = datetime.now(timezone.utc)
+    media_rows = (
+        {"filename": name, "sha256": sha, "exported_at": now}
+        for name in filenames
+        if (sha := shipped_media_sha256(name, profile)) is not None
+    )
+    for batch in itertools.batched(media_rows, _UPSERT_BATCH_SIZE):
+        stmt = insert(ExportedMedia)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ExportedMedia.filename],
+            set_={"sha256": stmt.excluded.sha256, "exported_at": now},
+        )
+        db.session.execute(stmt, list(batch))
@@ -0,0 +1,147 @@
+"""Background export jobs.
+
+Large exports can outlast browser and proxy timeouts, so they can run on a
+worker thread instead: submit a selection, poll the job for progress, and
+download the package once it is done. Jobs live in process memory.
+
+A job's export is only recorded in the export history when its package is
+first downloaded, so a job that is never collected (or whose package was
+pruned from the deck cache first) doesn't hold back later delta exports.
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from flask import Flask
+
+from app.services.export_history import PendingExport
+from app.services.export_metrics import ExportMetrics
+from app.services.exports import ExportSelection, prepare_export
+
+_MAX_WORKERS = 2
+# Finished jobs are forgotten after this many seconds.
+_JOB_TTL = 60 * 60
+
+_executor = ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix="export")
+_jobs: dict[str, "ExportJob"] = {}
+_jobs_lock = threading.Lock()
+
+
+class ExportJob:
+    """State of one background export, updated by its worker thread.
+
+    `status` moves from "queued" to "running" and then to "done", "empty"
+    (the selection matched nobody) or "failed".
+    """
+
+    def __init__(
+        self,
+        person_ids: list[str],
+        mode: str,
+        split_by: str | None = None,
+        profile: str = "full",
+    ) -> None:
+        self.id = uuid.uuid4().hex
+        self.person_ids = person_ids
+        self.mode = mode
+        self.split_by = split_by
+        self.profile = profile
+        self.status = "queued"
+        self.error: str | None = None
+        self.notes_total = 0
+        self.notes_written = 0
+        self.media_bytes = 0
+        self.output_path: str | None = None
+        self._pending: PendingExport | None = None
+        self.metrics = ExportMetrics(f"job {self.id}")
+        self.finished_at: float | None = None
+
+    def _on_progress(self, notes_written: int, media_bytes: int) -> None:
+        self.notes_written = notes_written
+        self.media_bytes = media_bytes
+
+    def take_pending(self) -> PendingExport | None:
+        """Return the export to record on first download, then None."""
+        with _jobs_lock:
+            pending, self._pending = self._pending, None
+        return pending
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "split_by": self.split_by,
+            "profile": self.profile,
+            "status": self.status,
+            "error": self.error,
+            "notes_total": self.notes_total,
+            "notes_written": self.notes_written,
+            "media_bytes": self.media_bytes,
+            "timings": self.metrics.to_dict(),
+            "download_url": (
+                f"/deck/jobs/{self.id}/download" if self.status == "done" else None
+            ),
+        }
+
+
+def _run(app: Flask, job: ExportJob) -> None:
+    job.status = "running"
+    # Timed from when a worker picks the job up, not from when it was queued.
+    job.metrics = ExportMetrics(f"job {job.id}")
+    try:
+        with app.app_context():
+            started_at = datetime.now(timezone.utc)
+            with ExportSelection(job.person_ids, job.mode) as selection:
+                job.notes_total = selection.count()
+                if job.notes_total:
+                    job.output_path, job._pending = prepare_export(
+                        selection,
+                        started_at,
+                        on_progress=job._on_progress,
+                        split_by=job.split_by,
+                        profile=job.profile,
+                        metrics=job.metrics,
+                    )
+                    # A cache hit never reports progress.
+                    job.notes_written = job.notes_total
+                    job.metrics.finish()
+        job.status = "done" if job.output_path else "empty"
+    except Exception as e:
+        app.logger.exception("Export job %s failed", job.id)
+        job.error = str(e)
+        job.status = "failed"
+    finally:
+        job.finished_at = time.monotonic()
+
+
+def _forget_expired_jobs() -> None:
+    cutoff = time.monotonic() - _JOB_TTL
+    with _jobs_lock:
+        for job_id in [
+            j.id for j in _jobs.values() if j.finished_at and j.finished_at < cutoff
+        ]:
+            del _jobs[job_id]
+
+
+def submit_export(
+    app: Flask,
+    person_ids: list[str],
+    mode: str,
+    split_by: str | None = None,
+    profile: str = "full",
+) -> ExportJob:
+    """Queue an export of the given selection and return its job."""
+    _forget_expired_jobs()
+    job = ExportJob(person_ids, mode, split_by, profile)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    _executor.submit(_run, app, job)
+    return job
+
+
+def get_job(job_id: str) -> ExportJob | None:
+    with _jobs_lock:
+        return _jobs.get(job_id)
@@ -0,0 +1,162 @@
+"""Per-stage timings for exports, to see where a slow export spends its time.
+
+An ExportMetrics is threaded through an export and each stage adds to it:
+
+  history  checking which photos Anki already has ("update" and "changed")
+  digest   hashing the selected rows to look up the deck cache
+  load     reading person rows from the database while notes are built
+  notes    rendering notes and writing the collection database
+  media    waiting for photos to be read (and re-encoded) by the read-ahead pool
+  zip      writing entries into the package
+  record   remembering the export for later delta exports
+
+Finished exports are logged, kept for GET /deck/metrics, and sent back to the
+browser in a Server-Timing header. Set NAMES_AND_FACES_TRACE_MEMORY=1 to also
+record each stage's peak traced allocation; tracemalloc slows exports down
+considerably and its peak is process-wide, so concurrent exports blur it.
+"""
+
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+
+TRACE_MEMORY = os.environ.get("NAMES_AND_FACES_TRACE_MEMORY") == "1"
+
+# How many finished exports GET /deck/metrics reports.
+_RECENT_KEEP = 20
+
+logger = logging.getLogger(__name__)
+_recent: deque[dict] = deque(maxlen=_RECENT_KEEP)
+_recent_lock = threading.Lock()
+
+
+class Stage:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.peak_bytes: int | None = None
+
+    def to_dict(self) -> dict:
+        d = {
+            "seconds": round(self.seconds, 4),
+            "items": self.items,
+            "bytes": self.bytes,
+        }
+        if self.peak_bytes is not None:
+            d["peak_bytes"] = self.peak_bytes
+        return d
+
+
+class ExportMetrics:
+    """Durations, item counts and byte counts for the stages of one export.
+
+    A background job's metrics are read by status polls while its worker
+    thread adds stages, so stages are added and listed under a lock.
+    """
+
+    def __init__(self, label: str = "export", trace_memory: bool = TRACE_MEMORY):
+        self.label = label
+        self.trace_memory = trace_memory
+        self.stages: dict[str, Stage] = {}
+        self._stages_lock = threading.Lock()
+        self.cached = False
+        self._started = time.perf_counter()
+        self.total_seconds: float | None = None
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def get(self, name: str) -> Stage:
+        with self._stages_lock:
+            if name not in self.stages:
+                self.stages[name] = Stage(name)
+            return self.stages[name]
+
+    def _stage_items(self) -> list[tuple[str, Stage]]:
+        with self._stages_lock:
+            return list(self.stages.items())
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Stage]:
+        """Time a block as (part of) stage `name`."""
+        stage = self.get(name)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - start
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - base
+                stage.peak_bytes = max(stage.peak_bytes or 0, peak)
+
+    def timed_rows(self, rows: Iterable, name: str = "load") -> Iterator:
+        """Yield from `rows`, counting the time spent fetching them as `name`."""
+        stage = self.get(name)
+        it = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(it)
+            except StopIteration:
+                stage.seconds += time.perf_counter() - start
+                return
+            stage.seconds += time.perf_counter() - start
+            stage.items += 1
+            yield row
+
+    def finish(self) -> None:
+        """Log the export and keep it for GET /deck/metrics."""
+        self.total_seconds = time.perf_counter() - self._started
+        logger.info("%s", self.summary())
+        with _recent_lock:
+            _recent.append(self.to_dict())
+
+    def summary(self) -> str:
+        total = self.total_seconds or (time.perf_counter() - self._started)
+        stages = self._stage_items()
+        parts = [f"{name} {s.seconds:.3f}s" for name, s in stages]
+        named = dict(stages)
+        notes = named.get("notes")
+        media = named.get("media")
+        line = (
+            f"{self.label}: {notes.items if notes else 0} notes,"
+            f" {media.items if media else 0} media"
+            f" ({(media.bytes if media else 0) / 1e6:.1f} MB)"
+            f" in {total:.3f}s{' (cached)' if self.cached else ''}"
+            f" [{', '.join(parts)}]"
+        )
+        peaks = [s.peak_bytes for _, s in stages if s.peak_bytes]
+        if peaks:
+            line += f" peak {max(peaks) / 1e6:.1f} MB"
+        return line
+
+    def server_timing(self) -> str:
+        """Return the stages as a Server-Timing header value (durations in ms)."""
+        return ", ".join(
+            f"{name};dur={s.seconds * 1000:.1f}" for name, s in self._stage_items()
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "label": self.label,
+            "cached": self.cached,
+            "total_seconds": (
+                round(self.total_seconds, 4) if self.total_seconds is not None else None
+            ),
+            "stages": {name: s.to_dict() for name, s in self._stage_items()},
+        }
+
+
+def recent_exports() -> list[dict]:
+    """Return the metrics of the most recent exports, newest first."""
+    with _recent_lock:
+        return list(reversed(_recent))
@@ -0,0 +1,285 @@
+"""Selecting people for an export and turning them into a package.
+
+Shared by the synchronous /deck/export endpoint and background export jobs.
+"""
+
+import hashlib
+import itertools
+import uuid
+from collections.abc import Iterator
+from datetime import datetime
+from types import TracebackType
+
+from sqlalchemy import text
+from sqlalchemy.engine import Row
+
+from app import db
+from app.models import Person
+from app.services.deck_generator import (
+    PACKAGE_FORMAT,
+    ProgressCallback,
+    build_cached_deck,
+    template_hash,
+    template_timestamp,
+)
+from app.services.export_history import (
+    PendingExport,
+    already_exported_media,
+    last_full_export_time,
+)
+from app.services.export_metrics import ExportMetrics
+from app.services.images import EXPORT_PROFILES
+
+# "full" ships every selected note and photo, "update" leaves out photos Anki
+# already has, and "changed" additionally leaves out people not edited since
+# the last export of the whole collection.
+EXPORT_MODES = {"full", "update", "changed"}
+
+# The only columns deck generation reads.
+EXPORT_COLUMNS = (
+    Person.id,
+    Person.note_guid,
+    Person.note_fields,
+    Person.note_version,
+    Person.name,
+    Person.context,
+    Person.face_filename,
+    Person.card_face_to_name,
+    Person.card_name_to_face,
+    Person.card_name_face_to_context,
+    Person.card_context_to_person,
+    Person.source,
+    Person.updated_at,
+)
+
+_FETCH_BATCH_SIZE = 1000
+_SELECTION_INSERT_BATCH_SIZE = 5000
+
+
+class ExportSelection:
+    """The people an export covers, read in batches on every pass.
+
+    Building a package makes several passes over the selection (cache digest,
+    media lookup, notes, history), so rather than holding every row in memory
+    each pass re-runs the query and streams plain column rows.
+
+    Explicit person ids are loaded into a temporary table and joined against,
+    so selections of any size stay clear of SQLite's bound-parameter limit.
+    Use as a context manager so those rows are cleared afterwards.
+
+    `sources` and `changed_since` narrow the selection further; either makes
+    it partial, like explicit ids, so it doesn't count as a baseline for later
+    "changed" exports.
+    """
+
+    def __init__(
+        self,
+        person_ids: list[str],
+        mode: str,
+        *,
+        sources: list[str] | None = None,
+        changed_since: datetime | None = None,
+    ) -> None:
+        # Before the temp-table rows below open a transaction, which would
+        # keep template_timestamp from recording a template change.
+        template_timestamp()
+        self.person_ids = person_ids
+        self.mode = mode
+        self.sources = sources or []
+        self.changed_since = changed_since
+        self._criteria = []
+        self._since: datetime | None = None
+        self._key: str | None = None
+        if self.sources:
+            self._criteria.append(Person.source.in_(self.sources))
+        if changed_since is not None:
+            self._criteria.append(Person.updated_at > changed_since)
+        if person_ids:
+            self._key = _save_selection(person_ids)
+            self._criteria.append(
+                Person.id.in_(
+                    text(
+                        "SELECT person_id FROM temp.export_selection"
+                        " WHERE selection_key = :selection_key"
+                    ).bindparams(selection_key=self._key)
+                )
+            )
+        if mode == "changed":
+            # Resolved once so every pass sees the same selection.
+            self._since = last_full_export_time()
+            if self._since is not None:
+                self._criteria.append(Person.updated_at > self._since)
+
+    def __enter__(self) -> "ExportSelection":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        if exc_type is not None:
+            # Rolling back also discards this selection's temp-table rows.
+            db.session.rollback()
+            self._key = None
+        self.close()
+
+    def close(self, commit: bool = True) -> None:
+        if self._key is not None:
+            db.session.execute(
+                text("DELETE FROM temp.export_selection WHERE selection_key = :k"),
+                {"k": self._key},
+            )
+            self._key = None
+            if commit:
+                db.session.commit()
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.person_ids or self.sources or self.changed_since)
+
+    def count(self) -> int:
+        stmt = db.select(db.func.count()).select_from(Person).where(*self._criteria)
+        return db.session.execute(stmt).scalar_one()
+
+    def etag(self, split_by: str | None = None, profile: str = "full") -> str:
+        """Return a validator that changes whenever the export would.
+
+        Uses one aggregate query instead of reading the rows: any edit bumps
+        max(updated_at), and deletions change the count. For "update" exports
+        the set of skipped photos can still grow without changing the tag,
+        which only means a client keeps a package with a few extra photos.
+        """
+        stmt = (
+            db.select(db.func.count(), db.func.max(Person.updated_at))
+            .select_from(Person)
+            .where(*self._criteria)
+        )
+        count, last_updated = db.session.execute(stmt).one()
+        parts = [
+            self.mode,
+            split_by or "",
+            # A package built by other code, or with other photo settings,
+            # differs even when the rows don't.
+            f"{PACKAGE_FORMAT}",
+            f"{profile}:{EXPORT_PROFILES.get(profile)}",
+            str(count),
+            last_updated.isoformat() if last_updated else "",
+            self._since.isoformat() if self._since else "",
+            self.changed_since.isoformat() if self.changed_since else "",
+            template_hash(),
+            *sorted(self.sources),
+            "",
+            *sorted(self.person_ids),
+        ]
+        return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()[:32]
+
+    def __iter__(self) -> Iterator[Row]:
+        stmt = (
+            db.select(*EXPORT_COLUMNS)
+            .where(*self._criteria)
+            .order_by(Person.created_at, Person.id)
+            .execution_options(yield_per=_FETCH_BATCH_SIZE)
+        )
+        yield from db.session.execute(stmt)
+
+
+def _save_selection(person_ids: list[str]) -> str:
+    """Store `person_ids` in this connection's temp table; return their key.
+
+    The rows live on the session's connection, which it keeps until the next
+    commit; export_people only commits once it is done reading the selection.
+    """
+    key = uuid.uuid4().hex
+    db.session.execute(
+        text(
+            "CREATE TEMP TABLE IF NOT EXISTS export_selection ("
+            " selection_key TEXT NOT NULL,"
+            " person_id TEXT NOT NULL,"
+            " PRIMARY KEY (selection_key, person_id))"
+        )
+    )
+    insert = text(
+        "INSERT OR IGNORE INTO temp.export_selection (selection_key, person_id)"
+        " VALUES (:selection_key, :person_id)"
+    )
+    for batch in itertools.batched(person_ids, _SELECTION_INSERT_BATCH_SIZE):
+        db.session.execute(
+            insert, [{"selection_key": key, "person_id": pid} for pid in batch]
+        )
+    return key
+
+
+def export_people(
+    selection: ExportSelection,
+    started_at: datetime,
+    on_progress: ProgressCallback | None = None,
+    split_by: str | None = None,
+    profile: str = "full",
+    metrics: ExportMetrics | None = None,
+) -> str:
+    """Build (or reuse) the package for `selection` and record the export.
+
+    Returns the path of the package. `started_at` should be taken before the
+    selection was created; see PendingExport.record. `split_by` is one of
+    deck_generator.SPLIT_MODES, or None for a single deck. `profile` is one of
+    images.EXPORT_PROFILES. Stage timings are added to `metrics`, which is
+    finished (logged and kept for GET /deck/metrics) before returning.
+    """
+    metrics = metrics or ExportMetrics()
+    output_path, pending = prepare_export(
+        selection, started_at, on_progress, split_by, profile, metrics
+    )
+    finish_export(selection, pending, metrics)
+    return output_path
+
+
+def prepare_export(
+    selection: ExportSelection,
+    started_at: datetime,
+    on_progress: ProgressCallback | None = None,
+    split_by: str | None = None,
+    profile: str = "full",
+    metrics: ExportMetrics | None = None,
+) -> tuple[str, PendingExport]:
+    """Build (or reuse) the package for `selection` without recording it.
+
+    Returns the path of the package and the export to record once the package
+    has reached the user. Arguments are as for export_people; `metrics` is
+    not finished.
+    """
+    metrics = metrics or ExportMetrics()
+    exclude_media = None
+    if selection.mode != "full":
+        with metrics.stage("history"):
+            exclude_media = already_exported_media(selection, profile)
+    output_path, filenames = build_cached_deck(
+        selection, exclude_media, on_progress, split_by, profile, metrics
+    )
+    with metrics.stage("record"):
+        pending = PendingExport(
+            filenames,
+            selection.count(),
+            selection.mode,
+            started_at,
+            partial=selection.partial,
+            profile=profile,
+        )
+    return output_path, pending
+
+
+def finish_export(
+    selection: ExportSelection, pending: PendingExport, metrics: ExportMetrics
+) -> None:
+    """Record a prepared export, release `selection`, commit and finish `metrics`.
+
+    Call it once the package has been opened for the user: another export
+    can prune a cached package until then (open files stay readable).
+    """
+    with metrics.stage("record"):
+        pending.record()
+        # Clear the temp-table rows before committing hands the connection back.
+        selection.close(commit=False)
+        db.session.commit()
+    metrics.finish()
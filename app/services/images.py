@@ -1,52 +1,265 @@
-"""Image processing utilities. Resizes and compresses profile photos."""
+"""Image processing utilities. Resizes and compresses profile photos.
 
+Photos in MEDIA_DIR are named by the SHA-256 of their optimized bytes, so a
+photo saved twice is stored once and shared by everyone who uses it.
+"""
+
+import glob
+import hashlib
+import io
 import os
+import re
+import threading
+import time
 import uuid
 from typing import IO
 
-from PIL import Image
+from PIL import Image, features
 from PIL.Image import Resampling
 
-from app import MEDIA_DIR
+from app import CACHE_DIR, MEDIA_DIR, db
+from app.models import Person
 
 MAX_DIMENSION = 400
 JPEG_QUALITY = 85
+# Uploads are first shrunk by whole factors (for JPEGs, while decoding) to no
+# less than this many times the target size, then resampled with LANCZOS.
+REDUCING_GAP = 2.0
+
+DERIVATIVE_DIR = os.path.join(CACHE_DIR, "derivatives")
+
+# Re-encodings applied to photos when they are packaged for Anki, as
+# (max dimension, JPEG quality). "full" ships the stored file unchanged.
+EXPORT_PROFILES: dict[str, tuple[int, int] | None] = {
+    "full": None,
+    "mobile": (200, 70),
+}
+
+# Widths of the thumbnails the people grid picks from, and their quality. The
+# full-size one is only worth it as WebP; the grid uses the original JPEG.
+THUMBNAIL_SIZES = (96, 192, MAX_DIMENSION)
+THUMBNAIL_QUALITY = 80
+WEBP_SUPPORTED = features.check("webp")
+
+_CONTENT_NAME = re.compile(r"[0-9a-f]{64}")
+
+# A media file saved or reused this recently may belong to a person who isn't
+# committed yet, so delete_unreferenced_media leaves it alone.
+_REUSE_GRACE_SECONDS = 60
+# Makes "reuse or write" and "check age and remove" atomic within a process.
+_media_lock = threading.Lock()
+
+# path -> (mtime_ns, size, sha256). Media files are never rewritten in place
+# (reusing one only touches it), so the stat check is only a guard against
+# manual edits.
+_hash_cache: dict[str, tuple[int, int, str]] = {}
 
 
 def save_and_optimize(input_path_or_fileobj: str | IO[bytes]) -> str:
     """Resize an image to MAX_DIMENSION and save as JPEG.
 
     Accepts either a file path (str) or a file-like object.
-    Returns the filename of the saved image in MEDIA_DIR.
+    Returns the filename of the saved image in MEDIA_DIR, which is derived
+    from its contents; saving an identical photo returns the existing file.
     """
+    data = optimized_jpeg(input_path_or_fileobj)
+    filename = f"{hashlib.sha256(data).hexdigest()}.jpg"
+    filepath = os.path.join(MEDIA_DIR, filename)
+    with _media_lock:
+        try:
+            # Mark the existing copy as just used; see delete_unreferenced_media.
+            os.utime(filepath)
+        except FileNotFoundError:
+            _write_atomic(filepath, data)
+    return filename
+
+
+def optimized_jpeg(input_path_or_fileobj: str | IO[bytes]) -> bytes:
+    """Return an image resized to fit MAX_DIMENSION, encoded as JPEG."""
     img = Image.open(input_path_or_fileobj)
+    # Resampling filters don't apply to palette or bilevel images.
+    if img.mode in ("P", "1"):
+        img = img.convert("RGBA" if img.mode == "P" else "L")
+
+    # Resize before converting the mode, which would decode every pixel. A
+    # JPEG is decoded straight to the smallest DCT scale that is still
+    # REDUCING_GAP times the target, a quarter or less of a phone photo.
+    target = _fit(img.size, MAX_DIMENSION)
+    if target != img.size:
+        if img.format == "JPEG":
+            img.draft(
+                None, (int(target[0] * REDUCING_GAP), int(target[1] * REDUCING_GAP))
+            )
+        img = img.resize(target, Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
 
-    if img.mode in ("RGBA", "P", "LA"):
+    if img.mode in ("RGBA", "LA"):
         background = Image.new("RGB", img.size, (255, 255, 255))
-        if img.mode == "P":
-            img = img.convert("RGBA")
-        background.paste(img, mask=img.split()[-1] if "A" in img.mode else None)
+        background.paste(img, mask=img.split()[-1])
         img = background
     elif img.mode != "RGB":
         img = img.convert("RGB")
 
-    if img.width > MAX_DIMENSION or img.height > MAX_DIMENSION:
-        img.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def _fit(size: tuple[int, int], max_dimension: int) -> tuple[int, int]:
+    """Return `size` scaled down, keeping its aspect ratio, to fit a square."""
+    width, height = size
+    if width <= max_dimension and height <= max_dimension:
+        return size
+    scale = max_dimension / max(width, height)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # Write under a unique name and rename into place, so concurrent readers
+    # never see a partial file.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def delete_unreferenced_media(filename: str | None) -> bool:
+    """Delete a media file if no person uses it any more; return whether it was.
+
+    Photos are shared between people, so removing or replacing one person's
+    photo must go through here rather than deleting the file. Call it after
+    the change that dropped the reference has been committed.
+
+    A concurrent save of the same photo finds the file already there and
+    reuses it, but its person isn't committed yet, so the reference check
+    can't see it. Saving therefore touches the file, and files saved or
+    reused in the last _REUSE_GRACE_SECONDS are kept. A photo replaced that
+    quickly is left behind unreferenced rather than risk deleting one in use.
+    The lock only covers this process; a script deleting media while the
+    server saves the same photo relies on the grace period alone.
+
+    The file's thumbnails and export derivatives are deleted with it.
+    """
+    if not filename:
+        return False
+    in_use = db.session.execute(
+        db.select(Person.id).where(Person.face_filename == filename).limit(1)
+    ).first()
+    if in_use:
+        return False
+    path = os.path.join(MEDIA_DIR, filename)
+    with _media_lock:
+        try:
+            if time.time() - os.path.getmtime(path) < _REUSE_GRACE_SECONDS:
+                return False
+            source_hash = media_sha256(filename)
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+    if source_hash:
+        _delete_derivatives(source_hash)
+    return True
 
-    filename = f"{uuid.uuid4()}.jpg"
-    filepath = os.path.join(MEDIA_DIR, filename)
-    img.save(filepath, "JPEG", quality=JPEG_QUALITY, optimize=True)
-    return filename
 
+def _delete_derivatives(source_hash: str) -> None:
+    for path in glob.glob(os.path.join(DERIVATIVE_DIR, f"{source_hash}-*")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
-def optimize_existing(filepath: str) -> str | None:
-    """Optimize an existing image file in-place. Returns new filename or None on error."""
+
+def media_sha256(filename: str) -> str | None:
+    """Return the SHA-256 of a file in MEDIA_DIR, or None if it is missing.
+
+    Content-addressed names are taken at their word, without reading the file.
+    """
+    path = os.path.join(MEDIA_DIR, filename)
+    stem = os.path.splitext(filename)[0]
+    if _CONTENT_NAME.fullmatch(stem):
+        return stem if os.path.exists(path) else None
+    return file_sha256(path)
+
+
+def file_sha256(path: str) -> str | None:
+    """Return the SHA-256 of a file, or None if it is missing."""
     try:
-        new_filename = save_and_optimize(filepath)
-        if os.path.abspath(filepath) != os.path.abspath(
-            os.path.join(MEDIA_DIR, new_filename)
-        ):
-            os.remove(filepath)
-        return new_filename
-    except Exception:
+        st = os.stat(path)
+    except FileNotFoundError:
         return None
+
+    cached = _hash_cache.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _hash_cache[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def derivative_path(
+    filename: str, max_dimension: int, quality: int, webp: bool = False
+) -> str | None:
+    """Return a cached JPEG (or WebP) of a media file scaled to fit `max_dimension`.
+
+    Derivatives are keyed by the source's content hash and the encoding
+    parameters, so each is encoded once and reused by later callers. Returns
+    None if the source is missing.
+    """
+    source = os.path.join(MEDIA_DIR, filename)
+    source_hash = media_sha256(filename)
+    if source_hash is None:
+        return None
+
+    ext = "webp" if webp else "jpg"
+    name = f"{source_hash}-{max_dimension}q{quality}.{ext}"
+    path = os.path.join(DERIVATIVE_DIR, name)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(DERIVATIVE_DIR, exist_ok=True)
+    img = Image.open(source)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((max_dimension, max_dimension), Resampling.LANCZOS)
+    buf = io.BytesIO()
+    if webp:
+        img.save(buf, "WEBP", quality=quality, method=6)
+    else:
+        img.save(buf, "JPEG", quality=quality, optimize=True)
+    _write_atomic(path, buf.getvalue())
+    return path
+
+
+def thumbnail_path(filename: str, size: int, webp: bool = False) -> str | None:
+    """Return a cached thumbnail of a media file for the people grid.
+
+    `size` must be one of THUMBNAIL_SIZES. Returns None if the media file is
+    missing or `size` isn't offered.
+    """
+    if size not in THUMBNAIL_SIZES or (webp and not WEBP_SUPPORTED):
+        return None
+    return derivative_path(filename, size, THUMBNAIL_QUALITY, webp)
+
+
+def export_media_path(filename: str, profile: str = "full") -> str | None:
+    """Return the file to package for a media file under an export profile.
+
+    Falls back to the stored file if it can't be re-encoded. Returns None if
+    the media file is missing.
+    """
+    source = os.path.join(MEDIA_DIR, filename)
+    spec = EXPORT_PROFILES.get(profile)
+    if spec is None:
+        return source if os.path.exists(source) else None
+    try:
+        return derivative_path(filename, *spec)
+    except OSError:
+        return source
@@ -4,7 +4,8 @@ load_dotenv()
 
 from app import create_app  # noqa: E402
 
-app = create_app()
-
 if __name__ == "__main__":
+    # Not at import time: deck shard workers are spawned processes, which
+    # import the main module again.
+    app = create_app()
     app.run(debug=True, port=5050)
@@ -0,0 +1,106 @@
+"""Compare genanki's per-note writer with the bulk collection writer.
+
+Builds synthetic people in memory (no database, no media) and times writing a
+package both ways, after checking that both produce the same notes and cards.
+
+Usage: uv run python scripts/benchmark-deck-writer.py [SIZE ...]
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import zipfile
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import genanki  # noqa: E402
+
+from app.services.deck_generator import (  # noqa: E402
+    DECK_ID,
+    DECK_NAME,
+    PersonNote,
+    _build_model,
+    generate_deck,
+    person_fields,
+    render_note,
+)
+
+
+def synthetic_people(count: int) -> list[SimpleNamespace]:
+    people = [
+        SimpleNamespace(
+            id=f"00000000-0000-4000-8000-{i:012d}",
+            name=f"Person {i}",
+            context=f"Engineer at Company {i % 97}" if i % 2 else "",
+            face_filename=f"{i:08d}.jpg" if i % 3 else None,
+            card_face_to_name=True,
+            card_name_to_face=True,
+            card_name_face_to_context=True,
+            card_context_to_person=i % 5 == 0,
+        )
+        for i in range(count)
+    ]
+    # Rows carry their rendered note, as they do in the database.
+    for person in people:
+        render_note(person)
+    return people
+
+
+def write_with_genanki(people: list, output_path: str) -> None:
+    model = _build_model()
+    deck = genanki.Deck(DECK_ID, DECK_NAME)
+    for person in people:
+        deck.add_note(
+            PersonNote(person_id=person.id, model=model, fields=person_fields(person))
+        )
+    genanki.Package(deck).write_to_file(output_path)
+
+
+def collection_rows(apkg_path: str) -> tuple[list, list]:
+    with zipfile.ZipFile(apkg_path) as z, tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "collection.anki2")
+        with open(db_path, "wb") as f:
+            f.write(z.read("collection.anki2"))
+        conn = sqlite3.connect(db_path)
+        notes = conn.execute(
+            "SELECT guid, mid, tags, flds, sfld FROM notes ORDER BY guid"
+        ).fetchall()
+        cards = conn.execute(
+            "SELECT n.guid, c.did, c.ord, c.type, c.queue, c.due FROM cards c"
+            " JOIN notes n ON n.id = c.nid ORDER BY n.guid, c.ord"
+        ).fetchall()
+        conn.close()
+    return notes, cards
+
+
+def timed(fn, *args) -> float:  # type: ignore[no-untyped-def]
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    sizes = [int(a) for a in sys.argv[1:]] or [10_000, 100_000]
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            people = synthetic_people(size)
+            genanki_path = os.path.join(tmp, f"genanki-{size}.apkg")
+            bulk_path = os.path.join(tmp, f"bulk-{size}.apkg")
+
+            genanki_s = timed(write_with_genanki, people, genanki_path)
+            bulk_s = timed(generate_deck, people, bulk_path)
+
+            if collection_rows(genanki_path) != collection_rows(bulk_path):
+                sys.exit(f"{size}: bulk writer output differs from genanki")
+
+            print(
+                f"{size:>7} people: genanki {genanki_s:7.2f}s"
+                f"  bulk {bulk_s:7.2f}s  ({genanki_s / bulk_s:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
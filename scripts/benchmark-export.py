@@ -0,0 +1,346 @@
+"""Benchmark deck exports against synthetic collections.
+
+For each collection size, builds a throwaway data directory with that many
+synthetic people (a configurable share with photos and with context), then
+runs each export mode in a fresh process and records wall time, peak RSS and
+package size. Results are written as JSON so runs can be compared between
+commits.
+
+The "selected" case posts up to 50k person ids through the /deck/export form
+and fails unless the package holds exactly those people's notes and the
+temporary selection table is left empty.
+
+Usage:
+  uv run python scripts/benchmark-export.py --sizes 100,1000,10000 -o after.json
+  uv run python scripts/benchmark-export.py --compare before.json after.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in this order against the same data directory: a cold full build, the
+# same export served from the build cache, a cold build with every person id
+# passed explicitly, an update export once everything has been exported, and a
+# delta export after touching a small share of people.
+MODES = ("full", "cached", "selected", "update", "changed")
+CHANGED_SHARE = 0.01
+SELECTED_IDS = 50_000
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _load_app(data_dir: str):  # type: ignore[no-untyped-def]
+    os.environ["NAMES_AND_FACES_DATA_DIR"] = data_dir
+    os.environ["NAMES_AND_FACES_CACHE_DIR"] = os.path.join(data_dir, "cache")
+    sys.path.insert(0, ROOT)
+    from app import create_app
+
+    return create_app()
+
+
+def _sample_photo() -> bytes:
+    from PIL import Image, ImageFilter
+
+    img = Image.effect_noise((400, 400), 40).filter(ImageFilter.GaussianBlur(2))
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    return buf.getvalue()
+
+
+def populate(
+    data_dir: str, size: int, photo_share: float, context_share: float
+) -> None:
+    app = _load_app(data_dir)
+    from app import MEDIA_DIR, db
+    from app.models import Person
+
+    rng = random.Random(size)
+    photo = os.path.join(MEDIA_DIR, "sample.jpg")
+    with open(photo, "wb") as f:
+        f.write(_sample_photo())
+
+    created = datetime.now(timezone.utc) - timedelta(days=1)
+    rows = []
+    for i in range(size):
+        face = None
+        if rng.random() < photo_share:
+            face = f"{i:08d}.jpg"
+            # Hard links keep a 100k-photo collection cheap to set up while
+            # still making the exporter read one file per person.
+            try:
+                os.link(photo, os.path.join(MEDIA_DIR, face))
+            except OSError:
+                shutil.copyfile(photo, os.path.join(MEDIA_DIR, face))
+        rows.append(
+            {
+                "id": f"00000000-0000-4000-8000-{i:012d}",
+                "name": f"Person {i}",
+                "context": (
+                    f"Engineer at Company {i % 97}"
+                    if rng.random() < context_share
+                    else ""
+                ),
+                "face_filename": face,
+                "created_at": created,
+                "updated_at": created,
+            }
+        )
+
+    with app.app_context():
+        for start in range(0, len(rows), 5000):
+            db.session.execute(db.insert(Person), rows[start : start + 5000])
+        db.session.commit()
+
+
+def touch_people(data_dir: str, share: float) -> None:
+    app = _load_app(data_dir)
+    from app import db
+    from app.models import Person
+
+    with app.app_context():
+        ids = db.session.execute(db.select(Person.id)).scalars().all()
+        for person_id in ids[: max(1, int(len(ids) * share))]:
+            db.session.get(Person, person_id).context = "Changed"
+        db.session.commit()
+
+
+def _package_notes(path: str) -> int:
+    with tempfile.TemporaryDirectory() as scratch:
+        with zipfile.ZipFile(path) as z:
+            collection = z.extract("collection.anki2", scratch)
+        conn = sqlite3.connect(collection)
+        try:
+            return conn.execute("SELECT count(*) FROM notes").fetchone()[0]
+        finally:
+            conn.close()
+
+
+def _post_selection(app, person_ids: list[str], path: str) -> None:  # type: ignore[no-untyped-def]
+    """Export `person_ids` through the /deck/export form, saving the package."""
+    response = app.test_client().post(
+        "/deck/export",
+        data={"mode": "full", "person_ids": person_ids},
+        buffered=False,
+    )
+    try:
+        if response.status_code != 200:
+            raise RuntimeError(f"/deck/export answered {response.status_code}")
+        with open(path, "wb") as f:
+            for chunk in response.iter_encoded():
+                f.write(chunk)
+    finally:
+        response.close()
+
+
+def _leftover_selection_rows() -> int:
+    from app import db
+
+    # Temp tables belong to a connection, so check every pooled one; taking
+    # them all at once makes the pool hand out each of them.
+    db.session.close()
+    conns = [db.engine.raw_connection() for _ in range(db.engine.pool.checkedin())]
+    try:
+        rows = 0
+        for conn in conns:
+            cursor = conn.cursor()
+            (exists,) = cursor.execute(
+                "SELECT count(*) FROM sqlite_temp_master"
+                " WHERE name = 'export_selection'"
+            ).fetchone()
+            if exists:
+                rows += cursor.execute(
+                    "SELECT count(*) FROM temp.export_selection"
+                ).fetchone()[0]
+        return rows
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def run_export(data_dir: str, mode: str) -> dict:
+    app = _load_app(data_dir)
+    from app import db
+    from app.models import Person
+    from app.services.deck_generator import DECK_CACHE_DIR
+    from app.services.exports import ExportSelection, export_people
+
+    if mode != "cached":
+        shutil.rmtree(DECK_CACHE_DIR, ignore_errors=True)
+    export_mode = "full" if mode == "cached" else mode
+
+    with app.app_context():
+        if mode == "selected":
+            person_ids = (
+                db.session.execute(
+                    db.select(Person.id).order_by(Person.id).limit(SELECTED_IDS)
+                )
+                .scalars()
+                .all()
+            )
+            db.session.commit()
+            path = os.path.join(data_dir, "selected.apkg")
+            start = time.perf_counter()
+            _post_selection(app, person_ids, path)
+            wall = time.perf_counter() - start
+            leftover = _leftover_selection_rows()
+            if leftover:
+                raise RuntimeError(f"{leftover} rows left in temp.export_selection")
+        else:
+            start = time.perf_counter()
+            with ExportSelection([], export_mode) as selection:
+                path = export_people(selection, datetime.now(timezone.utc))
+            wall = time.perf_counter() - start
+
+    notes = _package_notes(path)
+    if mode == "selected" and notes != len(person_ids):
+        raise RuntimeError(f"{len(person_ids)} ids selected, {notes} notes exported")
+    return {
+        "mode": mode,
+        "notes": notes,
+        "wall_s": round(wall, 4),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "package_bytes": os.path.getsize(path),
+    }
+
+
+def _child(*args: str) -> str:
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", *args],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        sys.exit(f"{' '.join(args[:1] + args[2:])} failed:\n{result.stderr}")
+    return result.stdout
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark(args: argparse.Namespace) -> dict:
+    results = []
+    for size in args.sizes:
+        data_dir = tempfile.mkdtemp(prefix="names-and-faces-bench-")
+        try:
+            _child("populate", data_dir, str(size), str(args.photos), str(args.context))
+            for mode in args.modes:
+                if mode == "changed":
+                    _child("touch", data_dir, str(CHANGED_SHARE))
+                case = json.loads(_child("export", data_dir, mode))
+                case["size"] = size
+                results.append(case)
+                print(
+                    f"{size:>7} {mode:<8} {case['wall_s']:8.2f}s"
+                    f" {case['peak_rss_mb']:8.1f}MB RSS"
+                    f" {case['package_bytes'] / 1e6:9.2f}MB package"
+                    f" ({case['notes']} notes)",
+                    flush=True,
+                )
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "photo_share": args.photos,
+        "context_share": args.context,
+        "results": results,
+    }
+
+
+def compare(before_path: str, after_path: str) -> None:
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    old = {(r["size"], r["mode"]): r for r in before["results"]}
+    print(f"{before['revision']} -> {after['revision']}")
+    for new in after["results"]:
+        prev = old.get((new["size"], new["mode"]))
+        if not prev:
+            continue
+        print(
+            f"{new['size']:>7} {new['mode']:<8}"
+            f" wall {prev['wall_s']:7.2f}s -> {new['wall_s']:7.2f}s"
+            f" rss {prev['peak_rss_mb']:7.1f} -> {new['peak_rss_mb']:7.1f}MB"
+            f" size {prev['package_bytes'] / 1e6:8.2f} -> "
+            f"{new['package_bytes'] / 1e6:8.2f}MB"
+        )
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        command, data_dir, *rest = sys.argv[2:]
+        if command == "populate":
+            populate(data_dir, int(rest[0]), float(rest[1]), float(rest[2]))
+        elif command == "touch":
+            touch_people(data_dir, float(rest[0]))
+        elif command == "export":
+            print(json.dumps(run_export(data_dir, rest[0])))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[100, 1000, 10_000, 100_000],
+        help="comma-separated collection sizes (default: 100,1000,10000,100000)",
+    )
+    parser.add_argument(
+        "--modes",
+        type=lambda s: s.split(","),
+        default=list(MODES),
+        help=f"comma-separated subset of {','.join(MODES)}",
+    )
+    parser.add_argument("--photos", type=float, default=0.8, help="share with photos")
+    parser.add_argument("--context", type=float, default=0.6, help="share with context")
+    parser.add_argument("-o", "--output", help="write results JSON to this file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two runs"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = benchmark(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Benchmark resizing uploaded phone photos to the stored profile photo size.
+
+Generates synthetic 12-megapixel JPEGs (or uses the photos given on the
+command line) and runs each resize method over them in a fresh process,
+recording CPU time per image and the peak RSS the resizing added. Each
+method's output is compared with an exact LANCZOS resize of the fully decoded
+photo, as the mean absolute pixel difference (0-255).
+
+Methods:
+  full    decode every pixel, then an exact LANCZOS resize
+  before  convert the mode, then thumbnail() (the pipeline before draft mode)
+  after   optimized_jpeg(): DCT-scaled decoding and reducing_gap resizing
+
+Usage:
+  uv run python scripts/benchmark-image-resize.py [--photos 5] [--repeat 3]
+  uv run python scripts/benchmark-image-resize.py ~/Pictures/*.jpg
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METHODS = ("full", "before", "after")
+PHOTO_SIZE = (4032, 3024)
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _synthetic_photo(path: str, seed: int) -> None:
+    from PIL import Image, ImageFilter
+
+    # Smooth shapes with some grain compress like a photo, unlike pure noise.
+    w, h = PHOTO_SIZE
+    channels = [
+        Image.effect_noise((w // 16, h // 16), 60 + 10 * (seed + i))
+        .filter(ImageFilter.GaussianBlur(3))
+        .resize(PHOTO_SIZE, Image.Resampling.BICUBIC)
+        for i in range(3)
+    ]
+    grain = Image.effect_noise(PHOTO_SIZE, 8)
+    img = Image.merge("RGB", [Image.blend(c, grain, 0.15) for c in channels])
+    img.save(path, "JPEG", quality=92)
+
+
+def _before(path: str) -> bytes:
+    # save_and_optimize before it resized ahead of mode conversion and picked
+    # the DCT scale itself.
+    from PIL import Image
+    from PIL.Image import Resampling
+
+    from app.services.images import JPEG_QUALITY, MAX_DIMENSION
+
+    img = Image.open(path)
+    if img.mode in ("RGBA", "P", "LA"):
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        background.paste(img, mask=img.split()[-1] if "A" in img.mode else None)
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+    if img.width > MAX_DIMENSION or img.height > MAX_DIMENSION:
+        img.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def _full(path: str) -> bytes:
+    from app.services.images import JPEG_QUALITY
+
+    buf = io.BytesIO()
+    _reference(path).save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def _reference(path: str):  # type: ignore[no-untyped-def]
+    from PIL import Image
+    from PIL.Image import Resampling
+
+    from app.services.images import MAX_DIMENSION
+
+    img = Image.open(path).convert("RGB")
+    img.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Resampling.LANCZOS, None)
+    return img
+
+
+def _difference(data: bytes, reference) -> float:  # type: ignore[no-untyped-def]
+    from PIL import Image, ImageChops, ImageStat
+
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    if img.size != reference.size:
+        return float("nan")
+    diff = ImageStat.Stat(ImageChops.difference(img, reference))
+    return sum(diff.mean) / len(diff.mean)
+
+
+def run_method(method: str, photos: list[str], repeat: int) -> dict:
+    sys.path.insert(0, ROOT)
+    from PIL import Image
+
+    from app.services.images import optimized_jpeg
+
+    resize = {"full": _full, "before": _before, "after": optimized_jpeg}[method]
+    Image.init()
+    baseline = _peak_rss_mb()
+
+    cpu = 0.0
+    outputs = []
+    for _ in range(repeat):
+        outputs = []
+        for path in photos:
+            start = time.process_time()
+            outputs.append(resize(path))
+            cpu += time.process_time() - start
+    peak = _peak_rss_mb() - baseline
+
+    diffs = [_difference(d, _reference(p)) for d, p in zip(outputs, photos)]
+    return {
+        "method": method,
+        "cpu_ms_per_image": round(cpu * 1000 / (repeat * len(photos)), 1),
+        "peak_rss_added_mb": round(peak, 1),
+        "output_kb": round(sum(map(len, outputs)) / len(outputs) / 1024, 1),
+        "mean_abs_diff": round(sum(diffs) / len(diffs), 3),
+    }
+
+
+def _child(env: dict, *args: str) -> str:
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", *args],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    return result.stdout
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        command, *rest = sys.argv[2:]
+        if command == "generate":
+            _synthetic_photo(rest[0], int(rest[1]))
+        else:
+            print(json.dumps(run_method(command, rest[1:], int(rest[0]))))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("paths", nargs="*", help="photos to use instead")
+    parser.add_argument(
+        "--photos", type=int, default=5, help="synthetic photos to generate"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="passes per method")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="names-and-faces-bench-")
+    # Importing the app creates its data directories; keep them out of the way.
+    env = {
+        **os.environ,
+        "NAMES_AND_FACES_DATA_DIR": data_dir,
+        "NAMES_AND_FACES_CACHE_DIR": os.path.join(data_dir, "cache"),
+    }
+    try:
+        photos = [os.path.abspath(p) for p in args.paths]
+        if not photos:
+            for i in range(args.photos):
+                path = os.path.join(data_dir, f"photo-{i}.jpg")
+                # Linux carries peak RSS over into child processes, so keep
+                # the big images out of this one.
+                _child(env, "generate", path, str(i))
+                photos.append(path)
+        mb = sum(os.path.getsize(p) for p in photos) / len(photos) / 1e6
+        print(f"{len(photos)} photos, {mb:.1f}MB each on average")
+
+        for method in METHODS:
+            case = json.loads(_child(env, method, str(args.repeat), *photos))
+            print(
+                f"{method:<7} {case['cpu_ms_per_image']:8.1f}ms CPU/image"
+                f" {case['peak_rss_added_mb']:7.1f}MB peak RSS"
+                f" {case['output_kb']:6.1f}KB out"
+                f"  diff {case['mean_abs_diff']:.3f}",
+                flush=True,
+            )
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
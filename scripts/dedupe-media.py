@@ -0,0 +1,54 @@
+"""One-time script to move existing photos to content-addressed names.
+
+Photos saved before media was named by content hash have random names, so the
+same photo imported twice is stored twice. This renames each file to the hash
+of its bytes (without re-encoding it), points everyone at the shared copy and
+deletes the duplicates.
+
+Usage: uv run python scripts/dedupe-media.py
+"""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import MEDIA_DIR, create_app, db  # noqa: E402
+from app.models import Person  # noqa: E402
+from app.services.images import delete_unreferenced_media, file_sha256  # noqa: E402
+
+_CONTENT_NAME = re.compile(r"[0-9a-f]{64}\.\w+")
+
+app = create_app()
+
+with app.app_context():
+    people = Person.query.filter(Person.face_filename.isnot(None)).all()
+    renamed: dict[str, str] = {}
+    for person in people:
+        old = person.face_filename
+        if _CONTENT_NAME.fullmatch(old):
+            continue
+        if old not in renamed:
+            sha = file_sha256(os.path.join(MEDIA_DIR, old))
+            if sha is None:
+                print(f"  SKIP {person.name}: file missing ({old})")
+                continue
+            ext = os.path.splitext(old)[1].lower() or ".jpg"
+            new = f"{sha}{ext}"
+            new_path = os.path.join(MEDIA_DIR, new)
+            if not os.path.exists(new_path):
+                os.link(os.path.join(MEDIA_DIR, old), new_path)
+            renamed[old] = new
+        person.face_filename = renamed[old]
+
+    db.session.commit()
+    removed = sum(delete_unreferenced_media(old) for old in renamed)
+    print(
+        f"Renamed {len(renamed)} photos to {len(set(renamed.values()))} files,"
+        f" removed {removed} old files"
+    )
@@ -0,0 +1,255 @@
+"""Stand-in for AnkiConnect, for trying out `names-and-faces sync` without Anki.
+
+Implements the AnkiConnect actions the sync uses, keeping notes in memory and
+writing stored media to a directory. Prints each request's actions, and the
+note and media counts on exit.
+
+Usage:
+  uv run python scripts/fake-ankiconnect.py [--port 8765] [--media-dir DIR]
+  ANKICONNECT_URL=http://127.0.0.1:8765 uv run names-and-faces sync
+"""
+
+import argparse
+import base64
+import io
+import itertools
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeAnki:
+    def __init__(self, media_dir: str | None) -> None:
+        self.media_dir = media_dir
+        self.decks = {"Default"}
+        self.models: dict[str, dict] = {}
+        self.notes: dict[int, dict] = {}
+        self.media: dict[str, int] = {}
+        # Stored packages, kept whole for importPackage.
+        self.packages: dict[str, bytes] = {}
+        self._ids = itertools.count(1_700_000_000_000)
+        self._lock = threading.Lock()
+
+    def handle(self, request: dict) -> dict:
+        action = request.get("action", "")
+        try:
+            with self._lock:
+                result = self.dispatch(action, request.get("params", {}))
+            return {"result": result, "error": None}
+        except Exception as e:
+            return {"result": None, "error": str(e)}
+
+    def dispatch(self, action: str, params: dict) -> object:
+        handler = getattr(self, f"do_{action}", None)
+        if handler is None:
+            raise ValueError("unsupported action")
+        return handler(**params)
+
+    def do_version(self) -> int:
+        return 6
+
+    def do_multi(self, actions: list[dict]) -> list[dict]:
+        # Called with the lock already held.
+        results = []
+        for a in actions:
+            try:
+                result = self.dispatch(a["action"], a.get("params", {}))
+                results.append({"result": result, "error": None})
+            except Exception as e:
+                results.append({"result": None, "error": str(e)})
+        return results
+
+    def do_createDeck(self, deck: str) -> int:
+        self.decks.add(deck)
+        return abs(hash(deck)) % 10**13
+
+    def do_modelNames(self) -> list[str]:
+        return sorted(self.models)
+
+    def do_modelNamesAndIds(self) -> dict[str, int]:
+        return {name: m["id"] for name, m in self.models.items()}
+
+    def do_createModel(self, modelName: str, inOrderFields: list[str], **kw) -> dict:
+        if modelName in self.models:
+            raise ValueError("Model name already exists")
+        model_id = next(self._ids)
+        self.models[modelName] = {"id": model_id, "fields": inOrderFields, **kw}
+        return {"id": model_id, "name": modelName}
+
+    def do_updateModelTemplates(self, model: dict) -> None:
+        self.models[model["name"]]["templates"] = model["templates"]
+
+    def do_updateModelStyling(self, model: dict) -> None:
+        self.models[model["name"]]["css"] = model["css"]
+
+    def do_storeMediaFile(self, filename: str, data: str) -> str:
+        raw = base64.b64decode(data)
+        self.media[filename] = len(raw)
+        if filename.endswith(".apkg"):
+            self.packages[filename] = raw
+        if self.media_dir:
+            with open(os.path.join(self.media_dir, filename), "wb") as f:
+                f.write(raw)
+        return filename
+
+    def do_addNote(self, note: dict) -> int:
+        model = self.models.get(note["modelName"])
+        if model is None:
+            raise ValueError(f"model was not found: {note['modelName']}")
+        if note["deckName"] not in self.decks:
+            raise ValueError(f"deck was not found: {note['deckName']}")
+        if set(note["fields"]) - set(model["fields"]):
+            raise ValueError("unknown field")
+        note_id = next(self._ids)
+        self.notes[note_id] = {
+            "noteId": note_id,
+            # Like Anki, addNote picks a random GUID.
+            "guid": uuid.uuid4().hex[:10],
+            "modelName": note["modelName"],
+            "fields": dict(note["fields"]),
+            "tags": list(note.get("tags", [])),
+        }
+        return note_id
+
+    def do_updateNoteFields(self, note: dict) -> None:
+        existing = self.notes.get(note["id"])
+        if existing is None:
+            raise ValueError(f"Note was not found: {note['id']}")
+        existing["fields"].update(note["fields"])
+
+    def do_findNotes(self, query: str) -> list[int]:
+        # Understands the "note:NAME" and (-)"tag:PREFIX*" terms the sync sends.
+        model = re.search(r'"note:([^"]+)"', query)
+        tag = re.search(r'(-?)"tag:([^"*]+)\*?"', query)
+
+        def tag_matches(note: dict) -> bool:
+            if not tag:
+                return True
+            negate, prefix = tag.groups()
+            return any(t.startswith(prefix) for t in note["tags"]) != bool(negate)
+
+        return [
+            n["noteId"]
+            for n in self.notes.values()
+            if (not model or n["modelName"] == model.group(1)) and tag_matches(n)
+        ]
+
+    def do_notesInfo(self, notes: list[int]) -> list[dict]:
+        return [
+            {**n, "fields": {k: {"value": v} for k, v in n["fields"].items()}}
+            for n in (self.notes[i] for i in notes if i in self.notes)
+        ]
+
+    def do_deleteNotes(self, notes: list[int]) -> None:
+        for note_id in notes:
+            self.notes.pop(note_id, None)
+
+    def do_deleteMediaFile(self, filename: str) -> None:
+        self.media.pop(filename, None)
+        self.packages.pop(filename, None)
+        if self.media_dir:
+            try:
+                os.remove(os.path.join(self.media_dir, filename))
+            except FileNotFoundError:
+                pass
+
+    def do_importPackage(self, path: str) -> bool:
+        """Add the package's note types, decks and notes, matching notes by GUID.
+
+        Like Anki, a note type is matched by id, so one of the same name that
+        was created some other way ends up beside it.
+        """
+        with zipfile.ZipFile(io.BytesIO(self.packages[path])) as z:
+            collection = z.read("collection.anki2")
+        with tempfile.NamedTemporaryFile(suffix=".anki2") as f:
+            f.write(collection)
+            f.flush()
+            conn = sqlite3.connect(f.name)
+            try:
+                models_json, decks_json = conn.execute(
+                    "SELECT models, decks FROM col"
+                ).fetchone()
+                rows = conn.execute(
+                    "SELECT guid, mid, tags, flds FROM notes"
+                ).fetchall()
+            finally:
+                conn.close()
+
+        names = {}
+        for model in json.loads(models_json).values():
+            model_id = int(model["id"])
+            name = model["name"]
+            if model_id not in {m["id"] for m in self.models.values()}:
+                if name in self.models:
+                    name = f"{name}-{model_id}"
+                self.models[name] = {
+                    "id": model_id,
+                    "fields": [f["name"] for f in model["flds"]],
+                }
+            names[model_id] = next(
+                n for n, m in self.models.items() if m["id"] == model_id
+            )
+        self.decks.update(d["name"] for d in json.loads(decks_json).values())
+
+        by_guid = {n.get("guid"): n for n in self.notes.values()}
+        for guid, mid, tags, flds in rows:
+            fields = dict(zip(self.models[names[mid]]["fields"], flds.split("\x1f")))
+            if guid in by_guid:
+                by_guid[guid]["fields"] = fields
+                continue
+            note_id = next(self._ids)
+            self.notes[note_id] = {
+                "noteId": note_id,
+                "guid": guid,
+                "modelName": names[mid],
+                "fields": fields,
+                "tags": tags.split(),
+            }
+        return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--media-dir", help="write stored media files here")
+    args = parser.parse_args()
+    if args.media_dir:
+        os.makedirs(args.media_dir, exist_ok=True)
+    anki = FakeAnki(args.media_dir)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            inner = request.get("params", {}).get("actions")
+            suffix = f" ({len(inner)} actions)" if inner else ""
+            print(f"{request.get('action')}{suffix}", flush=True)
+            body = json.dumps(anki.handle(request)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            pass
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Fake AnkiConnect listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"{len(anki.notes)} notes, {len(anki.media)} media files")
+
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,13 @@ if [ -n "${LINKEDIN_LI_AT:-}" ]; then
         <string>${LINKEDIN_LI_AT}</string>"
 fi
 
+CACHE_PLIST_ENTRY=""
+if [ -n "${NAMES_AND_FACES_CACHE_DIR:-}" ]; then
+    CACHE_PLIST_ENTRY="
+        <key>NAMES_AND_FACES_CACHE_DIR</key>
+        <string>${NAMES_AND_FACES_CACHE_DIR}</string>"
+fi
+
 ANTHROPIC_PLIST_ENTRY=""
 if [ -n "${ANTHROPIC_API_KEY:-}" ]; then
     ANTHROPIC_PLIST_ENTRY="
@@ -64,7 +71,7 @@ cat > "$PLIST_PATH" <<PLIST
         <key>NAMES_AND_FACES_DATA_DIR</key>
         <string>${DATA_DIR}</string>
         <key>PATH</key>
-        <string>/opt/homebrew/bin:/usr/local/bin:/usr/bin:/bin</string>${LINKEDIN_PLIST_ENTRY}${ANTHROPIC_PLIST_ENTRY}
+        <string>/opt/homebrew/bin:/usr/local/bin:/usr/bin:/bin</string>${LINKEDIN_PLIST_ENTRY}${CACHE_PLIST_ENTRY}${ANTHROPIC_PLIST_ENTRY}
     </dict>
     <key>RunAtLoad</key>
     <true/>
@@ -1,12 +1,24 @@
-"""One-time script to optimize all existing images in the media directory.
+"""Optimize all existing images in the media directory.
 
 Resizes to 400x400 max and converts to JPEG. Updates database references.
 
-Usage: uv run python scripts/optimize-images.py
+Photos are re-encoded in a process pool and database references are updated
+and committed in batches. Every photo handled is recorded in a manifest (the
+hash of the original and the optimized file it became), so later runs skip
+photos that are already optimized, and a run that was interrupted picks up
+where it stopped without re-encoding anything.
+
+Usage: uv run python scripts/optimize-images.py [--workers N] [--batch-size N]
 """
 
+import argparse
+import itertools
+import json
+import multiprocessing
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -14,45 +26,191 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-from app import MEDIA_DIR, create_app, db  # noqa: E402
-from app.models import Person  # noqa: E402
-from app.services.images import save_and_optimize  # noqa: E402
-
-app = create_app()
-
-with app.app_context():
-    people = Person.query.all()
-    optimized = 0
-    saved_bytes = 0
-
-    for person in people:
-        if not person.face_filename:
-            continue
-
-        old_path = os.path.join(MEDIA_DIR, person.face_filename)
-        if not os.path.exists(old_path):
-            print(f"  SKIP {person.name}: file missing ({person.face_filename})")
-            continue
-
-        old_size = os.path.getsize(old_path)
-
-        try:
-            new_filename = save_and_optimize(old_path)
-        except Exception as e:
-            print(f"  FAIL {person.name}: {e}")
-            continue
-
-        new_path = os.path.join(MEDIA_DIR, new_filename)
-        new_size = os.path.getsize(new_path)
-
-        # Remove old file if different
-        if person.face_filename != new_filename and os.path.exists(old_path):
-            os.remove(old_path)
-
-        person.face_filename = new_filename
-        saved_bytes += old_size - new_size
-        optimized += 1
-        print(f"  OK {person.name}: {old_size // 1024}KB -> {new_size // 1024}KB")
+from PIL import Image  # noqa: E402
 
+from app import CACHE_DIR, MEDIA_DIR, create_app, db  # noqa: E402
+from app.models import Person  # noqa: E402
+from app.services.images import (  # noqa: E402
+    MAX_DIMENSION,
+    delete_unreferenced_media,
+    file_sha256,
+    save_and_optimize,
+)
+
+MANIFEST_PATH = os.path.join(CACHE_DIR, "optimize-images.jsonl")
+# Keeps each UPDATE's IN list well under SQLite's parameter limit.
+_QUERY_BATCH_SIZE = 500
+
+# Original hash -> optimized filename, from the manifest (set in each worker).
+_known: dict[str, str] = {}
+
+
+def _init_worker(known: dict[str, str]) -> None:
+    global _known
+    _known = known
+
+
+def _already_optimized(path: str, filename: str, sha: str) -> bool:
+    # Photos saved through the app are named by their hash and already fit;
+    # encoding them again would only lose quality. Only the header is read.
+    if filename != f"{sha}.jpg":
+        return False
+    with Image.open(path) as img:
+        return img.format == "JPEG" and max(img.size) <= MAX_DIMENSION
+
+
+def _optimize(filename: str) -> dict:
+    """Optimize one media file (in a worker process) and describe the result."""
+    path = os.path.join(MEDIA_DIR, filename)
+    try:
+        sha = file_sha256(path)
+        if sha is None:
+            return {"filename": filename, "skipped": "file missing"}
+        old_size = os.path.getsize(path)
+        output = _known.get(sha)
+        if not (output and os.path.exists(os.path.join(MEDIA_DIR, output))):
+            if _already_optimized(path, filename, sha):
+                output = filename
+            else:
+                output = save_and_optimize(path)
+        new_size = os.path.getsize(os.path.join(MEDIA_DIR, output))
+    except Exception as e:
+        return {"filename": filename, "error": str(e)}
+    return {
+        "filename": filename,
+        "source": sha,
+        "output": output,
+        "old_size": old_size,
+        "new_size": new_size,
+    }
+
+
+def load_manifest(path: str) -> dict[str, str]:
+    """Return original hash -> optimized filename for every photo handled."""
+    known: dict[str, str] = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash.
+                    continue
+                known[entry["source"]] = entry["output"]
+    except FileNotFoundError:
+        pass
+    return known
+
+
+def repoint(renamed: dict[str, str]) -> int:
+    """Point everyone using a renamed photo at its optimized file and commit.
+
+    Old files are deleted once nothing refers to them. Returns how many
+    people changed.
+    """
+    changed = 0
+    for batch in itertools.batched(renamed, _QUERY_BATCH_SIZE):
+        people = Person.query.filter(Person.face_filename.in_(batch)).all()
+        for person in people:
+            person.face_filename = renamed[person.face_filename]
+        changed += len(people)
     db.session.commit()
-    print(f"\nOptimized {optimized} images, saved {saved_bytes // 1024}KB")
+    # Other people may share the old file.
+    for old in renamed:
+        delete_unreferenced_media(old)
+    return changed
+
+
+def _report(done: int, total: int, start: float, read: int, saved: int) -> None:
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed else 0.0
+    eta = (total - done) / rate if rate else 0.0
+    print(
+        f"  {done}/{total} photos, {rate:.1f}/s, {read / 1e6 / elapsed:.1f} MB/s,"
+        f" saved {saved / 1e6:.1f}MB, {eta:.0f}s left",
+        flush=True,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="worker processes"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=200, help="photos per database commit"
+    )
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="manifest path")
+    args = parser.parse_args()
+
+    app = create_app()
+    known = load_manifest(args.manifest)
+    optimized = set(known.values())
+
+    with app.app_context():
+        filenames = sorted(
+            db.session.execute(
+                db.select(Person.face_filename)
+                .where(Person.face_filename.isnot(None))
+                .distinct()
+            ).scalars()
+        )
+        todo = [f for f in filenames if f not in optimized]
+        print(
+            f"{len(filenames)} photos, {len(filenames) - len(todo)} already"
+            f" optimized, {len(todo)} to do with {args.workers} workers"
+        )
+        if not todo:
+            return
+
+        start = time.perf_counter()
+        done = failed = skipped = people_changed = read_bytes = saved_bytes = 0
+        renamed: dict[str, str] = {}
+        # spawn rather than fork, as for deck shards: the parent holds an
+        # open database connection.
+        ctx = multiprocessing.get_context("spawn")
+        with (
+            # Line-buffered, so a crash loses at most the photo in hand.
+            open(args.manifest, "a", buffering=1) as manifest,
+            ProcessPoolExecutor(
+                max_workers=args.workers,
+                mp_context=ctx,
+                initializer=_init_worker,
+                initargs=(known,),
+            ) as pool,
+        ):
+            for result in pool.map(_optimize, todo, chunksize=4):
+                done += 1
+                if "skipped" in result:
+                    skipped += 1
+                    print(f"  SKIP {result['filename']}: {result['skipped']}")
+                elif "error" in result:
+                    failed += 1
+                    print(f"  FAIL {result['filename']}: {result['error']}")
+                else:
+                    manifest.write(
+                        json.dumps(
+                            {"source": result["source"], "output": result["output"]}
+                        )
+                        + "\n"
+                    )
+                    if result["output"] != result["filename"]:
+                        renamed[result["filename"]] = result["output"]
+                    read_bytes += result["old_size"]
+                    saved_bytes += result["old_size"] - result["new_size"]
+
+                if done % args.batch_size == 0 or done == len(todo):
+                    people_changed += repoint(renamed)
+                    renamed.clear()
+                    _report(done, len(todo), start, read_bytes, saved_bytes)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"\nOptimized {done - failed - skipped} images ({failed} failed,"
+        f" {skipped} skipped) in {elapsed:.1f}s,"
+        f" updated {people_changed} people, saved {saved_bytes // 1024}KB"
+    )
+
+
+if __name__ == "__main__":
+    main()